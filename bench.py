@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+#
+# Time the stages of convert_data.py (load, build, export) on a set of
+# extract files, synthetic ones by default:
+#
+#   python3 bench.py --scale 10 --status MARKETED INACTIVE
+#   python3 bench.py --dir /path/to/extracts --json bench_output.json
+#   python3 bench.py --csv-backend pyarrow --parity
+#
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+
+import convert_data
+import gen_extracts
+
+
+def run_stage(prod_status, stage, rows, func, *args):
+    #--------------------------------------------------------------------------
+    # run one stage under convert_data.run_stage and print its numbers
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    with convert_data.run_stage(stage, prod_status) as result:
+        func(*args)
+        result['rows'] = rows()
+    if tracemalloc.is_tracing():
+        result['traced_peak_mb'] = round(
+                tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+    print('  {:<10} {:<7} {:>10} rows {:>8.2f} s {:>10} rows/s {:>8} MB'
+            ' {:>8} MB workers'.format(prod_status, stage, result['rows'],
+                result['wall_s'], result['rows_per_s'] or 0,
+                result['peak_rss_mb'] or '-',
+                result['worker_peak_rss_mb'] or '-'))
+
+
+def loaded_rows():
+    return sum(len(convert_data.worksheet[key]['output'])
+            for key in convert_data.worksheet)
+
+
+def bench_status(prod_status, schedules, jobs):
+    drugs = lambda: len(convert_data.worksheet['drug_product']['output'])
+    run_stage(prod_status, 'load', loaded_rows,
+            convert_data.load_dpd_extracts, prod_status, jobs)
+    run_stage(prod_status, 'build', drugs,
+            convert_data.build_worksheet, prod_status)
+
+    drug_data = convert_data.load_build_data(prod_status)
+    run_stage(prod_status, 'export', lambda: len(drug_data),
+            convert_data.export_drug_data, drug_data, prod_status, schedules)
+    drug_data.close()
+
+    for key in convert_data.worksheet:
+        convert_data.worksheet[key]['output'] = []
+
+
+#-------------------------------------------------------------------------------
+if __name__ =='__main__':
+    parser = argparse.ArgumentParser(description='benchmark the stages of '
+            'convert_data.py')
+    parser.add_argument('--dir', help='directory with the extract files; '
+            'synthetic extracts are generated in a temporary directory when '
+            'not given')
+    parser.add_argument('--scale', type=float, default=1,
+            help='size of the synthetic extracts relative to the real ones')
+    parser.add_argument('--status', nargs='+',
+            choices=list(convert_data.suffixes), default=['MARKETED'])
+    parser.add_argument('--schedule', nargs='+',
+            choices=list(convert_data.output_prefixes), default=['ALL'])
+    parser.add_argument('--format', nargs='+',
+            choices=list(convert_data.output_sinks),
+            default=convert_data.output_formats)
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--csv-backend', choices=list(convert_data.csv_backends),
+            default=convert_data.csv_backend)
+    parser.add_argument('--parity', action='store_true',
+            help='first check that the installed csv backends read the '
+            'extracts exactly as the stdlib reader does')
+    parser.add_argument('--tracemalloc', action='store_true',
+            help='also record the peak of python allocations per stage '
+            '(slows the run down)')
+    parser.add_argument('--json', help='write the results to this file')
+    # set on the run timing the stages on the generated extracts
+    parser.add_argument('--generated', action='store_true',
+            help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.dir is None:
+        # the stages are timed in a fresh process, so that the peak memory
+        # of this one and of its children (the generator) does not hide the
+        # peaks of the stages
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            print('generating extracts (scale {})...'.format(args.scale))
+            gen_extracts.generate(tmp_dir, args.scale, args.status)
+            raise SystemExit(subprocess.run([sys.executable,
+                os.path.abspath(__file__)] + sys.argv[1:] +
+                ['--dir', tmp_dir, '--generated']).returncode)
+
+    convert_data.output_formats = args.format
+    convert_data.csv_backend = args.csv_backend
+    report = None if args.json is None else os.path.abspath(args.json)
+
+    os.chdir(args.dir)
+    if args.parity:
+        for prod_status in args.status:
+            if not convert_data.csv_backend_parity(prod_status):
+                raise SystemExit('csv backends differ for {}'.format(
+                    prod_status))
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    for prod_status in args.status:
+        bench_status(prod_status, args.schedule, args.jobs)
+    os.chdir('/')
+
+    if report is not None:
+        with open(report, 'w') as f:
+            json.dump({'scale': args.scale if args.generated else None,
+                'jobs': args.jobs, 'formats': args.format,
+                'csv_backend': args.csv_backend,
+                'schedules': args.schedule,
+                'results': convert_data.run_stages}, f, indent=1)
@@ -9,17 +9,141 @@
 # Drug Product Database (DPD) API Guide
 # https://health-products.canada.ca/api/documentation/dpd-documentation-en.html
 #
+import argparse
+import gzip
+import hashlib
+import io
 import json
+import mmap
+import re
+import select
+import signal
+import socket
+import struct
+import sys
 import csv
+import functools
 import os
 import shutil
 import sqlite3
+import tempfile
+import time
+import unicodedata
+import zipfile
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 
+try:
+    import resource
+except ImportError:
+    # not available on windows, peak memory is not reported
+    resource = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    # optional, only needed for the parquet and arrow outputs and the
+    # pyarrow csv backend
+    pa = None
+
+try:
+    import polars as pl
+except ImportError:
+    # optional, only needed for the polars csv backend
+    pl = None
+
 json_prefix = 'build_'
 
 build_prefix = 'build'
+# build data is saved as build_<STATUS>.dpdb; set build_json to also write
+# the older build_<STATUS>.json
+build_ext = '.dpdb'
+build_json = False
+# write the json outputs gzip compressed (.json.gz)
+json_gzip = False
+
+# strength units of the active ingredients -> (canonical unit, factor), and
+# the dosage units a strength is expressed per (250 MG / 5 ML)
+strength_units = {'KG': ('MG', 1e6), 'G': ('MG', 1e3), 'MG': ('MG', 1),
+        'MCG': ('MG', 1e-3), 'UG': ('MG', 1e-3), 'NG': ('MG', 1e-6),
+        'L': ('ML', 1e3), 'ML': ('ML', 1), 'MCL': ('ML', 1e-3),
+        'IU': ('IU', 1), 'KIU': ('IU', 1e3), 'MIU': ('IU', 1e6),
+        'MOL': ('MMOL', 1e3), 'MMOL': ('MMOL', 1)}
+dosage_units = {'L': ('ML', 1e3), 'ML': ('ML', 1), 'KG': ('G', 1e3),
+        'G': ('G', 1), 'MG': ('G', 1e-3)}
+
+# every build is kept as a release in history_<STATUS>.db, see
+# release_changes for the changes between two releases
+keep_history = True
+history_prefix = 'history'
+
+# outputs are written in publish_dir/<STATUS>-<time>/ and published as
+# symlinks of the same names in the current directory, swapped atomically;
+# the last publish_keep releases of a product status are kept
+publish_dir = 'releases'
+publish_keep = 3
+# files removed with the build data by (x)
+output_exts = ('.json', '.json.gz', '.dpdb', '.dpdb.tmp', '.codes', '.sql3',
+        '.parquet', '.arrow', '.shards')
+
+# watch mode: seconds between two checks of the extract files, seconds the
+# files must stay unchanged before a build, and the unix socket events are
+# sent to
+watch_interval = 5
+watch_debounce = 30
+watch_socket = 'dpd_watch.sock'
+
+# which record to keep when a DIN is listed more than once:
+# first, last_update or current_status (see resolve_duplicate_dins)
+dedup_policy = 'first'
+dedup_status_preference = ['MARKETED', 'APPROVED', 'DORMANT',
+        'CANCELLED POST MARKET', 'CANCELLED PRE MARKET']
+
+# outputs written for each schedule option:
+#   sqlite - <schedule>_<STATUS>.sql3
+#   json   - <schedule>_<STATUS>.json, firebase import file
+#   shards - <schedule>_<STATUS>.shards/, firebase import file split in
+#            shards of at most fb_shard_bytes by DIN prefix
+#   norm   - <schedule>_<STATUS>_norm.sql3, normalized tables with full
+#            text search over brand names and ingredients
+#   dict   - <schedule>_<STATUS>_dict.sql3, sqlite output with the repeated
+#            categorical values in integer keyed lookup tables
+#   dict_json - <schedule>_<STATUS>_dict.json, same for the firebase json
+#   parquet - <schedule>_<STATUS>.parquet, columnar build records (pyarrow)
+#   arrow  - <schedule>_<STATUS>.arrow, same in an Arrow IPC file (pyarrow)
+output_formats = ['sqlite', 'json']
+# compression and row group size of the parquet and arrow outputs
+arrow_compression = 'zstd'
+parquet_row_group_size = 50000
+fb_shard_bytes = 8 * 1024 * 1024
+fb_shard_prefix_len = 2
+build_magic = b'DPDB0002'
+# bump when the content of the build records changes, so that build data
+# from an older version is not reused
+build_format_version = 5
+# build record fields left out of the firebase json output
+build_only_fields = ['status_history', 'active_ingredients']
+# magic, record count, offsets position, DIN and drug_code index positions
+build_header = struct.Struct('<8sQQQQ')
+# key indexes of the build file: name, record field
+build_index_keys = [('din', 'drug_identification_number'),
+        ('drug_code', 'drug_code')]
 extract_dir = './allfiles'
+# location of the downloaded archives (allfiles*.zip, ther*.zip), read
+# directly when the extract directories are not there
+zip_dir = '.'
+# encoding of extract lines that are not valid UTF-8
+extract_encoding = 'cp1252'
+# reader of the extract files: stdlib (csv module), or pyarrow or polars to
+# parse whole files into columns when installed
+csv_backend = 'stdlib'
 source_files = ['biosimilar.txt','comp.txt','drug.txt','form.txt','ingred.txt',
         'package.txt','pharm.txt','route.txt','schedule.txt','status.txt',
         'ther.txt','vet.txt' ]
@@ -28,11 +152,35 @@ dpd_dataset = []
 build_dataset = []
 
 drug_prod_status = ['MARKETED']
-drug_schedule = 'OTC'
+drug_schedule = ['OTC']
+
+# output file prefix of each drug schedule option
+output_prefixes = {'OTC':'otc_', 'PRS':'prs_', 'OTC+PRS':'drugs_', 'ALL':'all_'}
+# dosage forms never exported as OTC drugs
+otc_excluded_forms = frozenset(['TEA (HERBAL)', 'SHAMPOO', 'SOAP', 'STICK',
+        'TOOTHPASTE', 'WIPE'])
+
+# sqlite3 bulk load settings
+sqlite_batch_size = 10000
+sqlite_load_pragmas = ['journal_mode = OFF', 'synchronous = OFF',
+        'cache_size = -262144', 'temp_store = MEMORY']
+sqlite_index_columns = ['id', 'drug_code', 'brand_name', 'company_code']
+
+# seconds between two progress lines
+progress_interval = 0.5
+# timings of the stages run by this process, see run_stage
+run_stages = []
+run_report_name = 'run_report.json'
+
+# number of worker processes used by the build: product statuses are built
+# in parallel, and the extract tables of a status are parsed in parallel
+build_jobs = os.cpu_count() or 1
 
 suffixes = {'MARKETED':'', 'APPROVED':'ap', 'INACTIVE':'ia', 'DORMANT':'dr'}
 
 # TODO: rename this variable
+# "keep" lists the fields the build uses; rows are held as compact records of
+# only those fields (all fields when not given)
 worksheet = {
     "active_ingredients": {
         "input": 'ingred',
@@ -41,7 +189,10 @@ worksheet = {
             "ingredient_supplied_ind","strength","strength_unit",
             "strength_type","dosage_value","base","dosage_unit","notes",
             "ingredients_f","strength_unit_f","strength_type_f",
-            "dosage_unit_f"]
+            "dosage_unit_f"],
+        "keep": ["drug_code","active_ingredient_code","ingredients",
+            "strength","strength_unit","dosage_value","dosage_unit",
+            "ingredients_f","strength_unit_f"]
     },
     "companies": {
         "input": 'comp',
@@ -50,7 +201,8 @@ worksheet = {
             "company_type","address_mailing_flag","address_billing_flag",
             "address_notification_flag","address_other","suite_number",
             "street_name","city_name","province","country","postal_code",
-            "post_office_box","province_f","country_f"]
+            "post_office_box","province_f","country_f"],
+        "keep": ["drug_code","company_code","company_name"]
     },
     "drug_product": {
         "input": 'drug',
@@ -65,229 +217,864 @@ worksheet = {
         "input": "status",
         "output": [],
         "fields": ["drug_code","current_status_flag","status","history_date",
+            "status_f","lot_number","expiration_date"],
+        "keep": ["drug_code","current_status_flag","status","history_date",
             "status_f","lot_number","expiration_date"]
     },
     "dosage_form": {
         "input": "form",
         "output": [],
         "fields": ["drug_code","pharm_form_code","pharmaceutical_form",
-            "pharmaceutical_form_f"]
+            "pharmaceutical_form_f"],
+        "keep": ["drug_code","pharmaceutical_form","pharmaceutical_form_f"]
     },
     "packaging": {
         "input": "package",
         "output": [],
         "fields": ["drug_code","upc","package_size_unit","package_type",
             "package_size","product_information","package_size_unit_f",
-            "package_type_f"]
+            "package_type_f"],
+        "keep": ["drug_code","upc","product_information"]
     },
     "pharmaceutical_standard": {
         "input": "pharm",
         "output": [],
-        "fields": ["drug_code","pharmaceutical_std"]
+        "fields": ["drug_code","pharmaceutical_std"],
+        "keep": ["drug_code","pharmaceutical_std"]
     },
     "route_of_administration": {
         "input": "route",
         "output": [],
         "fields": ["drug_code", "route_of_adminitration_code",
-            "route_of_administration","route_of_administration_f"]
+            "route_of_administration","route_of_administration_f"],
+        "keep": ["drug_code","route_of_administration",
+            "route_of_administration_f"]
     },
     "schedule": {
         "input": "schedule",
         "output": [],
-        "fields": ["drug_code","schedule","schedule_f"]
+        "fields": ["drug_code","schedule","schedule_f"],
+        "keep": ["drug_code","schedule","schedule_f"]
     },
     "therapeutic_class": {
         "input": "ther",
         "output": [],
         "fields": ["drug_code","tc_atc_number","tc_atc","tc_ahfs_number",
-            "tc_ahfs","tc_atc_f","tc_ahfs_f"]
+            "tc_ahfs","tc_atc_f","tc_ahfs_f"],
+        "keep": ["drug_code","tc_atc","tc_ahfs","tc_atc_f","tc_ahfs_f"]
     },
     "veterinary_species": {
         "input": "vet",
         "output": [],
-        "fields": ["drug_code","vet_species","vet_sub_species","vet_species_f"]
+        "fields": ["drug_code","vet_species","vet_sub_species","vet_species_f"],
+        "keep": ["drug_code","vet_species","vet_sub_species",
+            "vet_species_f"]
     }
 }
 
-def load_dpd_extracts(prod_status):
+# DPD data fields are not consistent; these are set on every loaded row,
+# overriding the extract value
+load_defaults = {'upc':'', 'packaging':'', 'packaging_f':'',
+        'pharmaceutical_std':''}
+
+
+def define_record_types():
     #--------------------------------------------------------------------------
-    # load dpd extracts
+    # one namedtuple record type per worksheet table, holding only the kept
+    # fields; published as module globals so that records can be pickled
+    for key in worksheet:
+        fields = worksheet[key]['fields']
+        keep = worksheet[key].get('keep', fields)
+        if keep is fields:
+            keep = fields + [f for f in load_defaults if f not in fields]
+
+        columns = []
+        for field in keep:
+            if field in load_defaults:
+                columns.append((None, load_defaults[field]))
+            else:
+                columns.append((fields.index(field), None))
+
+        # 'class' is not a valid attribute name; it is renamed in the record
+        # type and "names" keeps the real field names
+        name = ''.join(w.title() for w in key.split('_')) + 'Record'
+        record = namedtuple(name, keep, rename=True)
+        record.__module__ = __name__
+        globals()[name] = record
+        worksheet[key]['record'] = record
+        worksheet[key]['names'] = keep
+        worksheet[key]['columns'] = columns
+
+define_record_types()
+
+
+def extract_file_name(name, suffix):
+    # file name of an extract for a product status suffix: drug.txt, drug_ia.txt
+    if suffix == '':
+        return name + '.txt'
+    return '{}_{}.txt'.format(name, suffix)
+
+
+def extract_sources(prod_status):
+    #--------------------------------------------------------------------------
+    # locate the extract files of a product status, either unpacked in the
+    # extract directory or as members of the downloaded zip archives
+    # (allfiles*.zip and the separate ther*.zip); unpacked files win
+    # returns {file name: (archive or None, path)}
     suffix = suffixes[prod_status]
+    archive_name = zip_dir + '/' + os.path.basename(extract_dir)
+    if suffix == '':
+        dir_name = extract_dir
+        archives = [archive_name + '.zip', zip_dir + '/ther.zip']
+    else:
+        dir_name = extract_dir + '_' + suffix
+        archives = ['{}_{}.zip'.format(archive_name, suffix),
+                '{}/ther_{}.zip'.format(zip_dir, suffix)]
 
-    for key in worksheet:
+    sources = {}
+    for archive in archives:
+        if zipfile.is_zipfile(archive):
+            with zipfile.ZipFile(archive) as zf:
+                for member in zf.infolist():
+                    if not member.is_dir():
+                        name = os.path.basename(member.filename).lower()
+                        sources[name] = (archive, member.filename)
+
+    if os.path.isdir(dir_name):
+        for name in os.listdir(dir_name):
+            sources[name.lower()] = (None, dir_name + '/' + name)
 
-        if suffix == '':
-            fname = '{}/{}.txt'.format(extract_dir, worksheet[key]['input'])
+    return sources
+
+
+def open_extract(source):
+    # open an extract file (or zip member) for binary reading
+    archive, path = source
+    if archive is None:
+        return open(path, 'rb')
+    # the member keeps the archive open until it is closed
+    with zipfile.ZipFile(archive) as zf:
+        return zf.open(path)
+
+
+def decode_lines(binfile):
+    #--------------------------------------------------------------------------
+    # decode extract lines as they stream in; the extracts are mostly UTF-8
+    # but older files carry Windows-1252 accents, so fall back line by line
+    for line in binfile:
+        try:
+            line = line.decode('utf-8')
+        except UnicodeDecodeError:
+            line = line.decode(extract_encoding, 'replace')
+        # same line endings as a file opened in text mode
+        if line.endswith('\r\n'):
+            line = line[:-2] + '\n'
+        yield line
+
+
+def read_extract_data(source):
+    #--------------------------------------------------------------------------
+    # whole extract file as UTF-8 bytes for the bulk readers, decoded the
+    # same way as decode_lines: UTF-8, or line by line with the Windows-1252
+    # fallback, and \r\n line endings as \n
+    with open_extract(source) as binfile:
+        data = binfile.read()
+    try:
+        data.decode('utf-8')
+    except UnicodeDecodeError:
+        return ''.join(decode_lines(io.BytesIO(data))).encode('utf-8')
+    return data.replace(b'\r\n', b'\n')
+
+
+def records_from_columns(key, column, count):
+    # records of a worksheet table from column(field index), the values of
+    # a field, called only for the kept fields; with the interned strings
+    # and defaults of read_extract_stdlib
+    record = worksheet[key]['record']
+    columns = []
+    for col, default in worksheet[key]['columns']:
+        if col is None:
+            columns.append([default] * count)
         else:
-            # append suffix
-            fname = '{}_{}/{}_{}.txt'.format(extract_dir,
-                    suffix, worksheet[key]['input'], suffix)
+            columns.append([sys.intern(value) for value in column(col)])
+    return list(map(record._make, zip(*columns)))
+
+
+def read_extract_stdlib(key, source):
+    #--------------------------------------------------------------------------
+    # parse one extract file into the records of a worksheet table
+    record = worksheet[key]['record']
+    columns = worksheet[key]['columns']
+    nfields = len(worksheet[key]['fields'])
+
+    with open_extract(source) as csvfile:
+        output = []
+        for values in csv.reader(decode_lines(csvfile)):
+            # skip blank lines and pad short rows with None, as
+            # csv.DictReader does
+            if not values:
+                continue
+            if len(values) < nfields:
+                values += [None] * (nfields - len(values))
+
+            # repeated values (drug codes, forms, units...) share one
+            # interned string
+            row = []
+            for col, default in columns:
+                if col is None:
+                    row.append(default)
+                elif values[col] is None:
+                    row.append(None)
+                else:
+                    row.append(sys.intern(values[col]))
+            output.append(record._make(row))
+
+    return output
+
+
+def read_extract_pyarrow(key, source):
+    #--------------------------------------------------------------------------
+    # parse a whole extract file into columns with the pyarrow csv reader;
+    # every field is read as a string, empty fields stay empty strings
+    fields = worksheet[key]['fields']
+    table = pyarrow.csv.read_csv(io.BytesIO(read_extract_data(source)),
+            read_options=pyarrow.csv.ReadOptions(column_names=fields),
+            parse_options=pyarrow.csv.ParseOptions(newlines_in_values=True),
+            convert_options=pyarrow.csv.ConvertOptions(
+                column_types=dict((field, pa.string()) for field in fields),
+                strings_can_be_null=False, quoted_strings_can_be_null=False))
+    return records_from_columns(key, lambda n: table.column(n).to_pylist(),
+            table.num_rows)
+
+
+def read_extract_polars(key, source):
+    #--------------------------------------------------------------------------
+    # parse a whole extract file into columns with the polars csv reader
+    fields = worksheet[key]['fields']
+    frame = pl.read_csv(io.BytesIO(read_extract_data(source)),
+            has_header=False, new_columns=fields, infer_schema_length=0)
+    # polars reads blank lines and the missing fields of short rows as null,
+    # like unquoted empty fields; a null in the last field means a row the
+    # stdlib reader skips or pads, otherwise nulls are empty strings
+    if frame.get_column(fields[-1]).null_count():
+        raise ValueError('blank or short rows')
+    frame = frame.fill_null('')
+    return records_from_columns(key,
+            lambda n: frame.get_column(fields[n]).to_list(), frame.height)
+
+
+# csv_backend name -> reader of an extract file
+csv_backends = {'stdlib': read_extract_stdlib, 'pyarrow': read_extract_pyarrow,
+        'polars': read_extract_polars}
+
+# errors of the bulk readers on the files they cannot read (short, long or
+# blank rows, empty files), which are read with the stdlib reader instead
+csv_backend_errors = (ValueError,)
+if pa is not None:
+    csv_backend_errors += (pa.ArrowInvalid,)
+if pl is not None:
+    csv_backend_errors += (pl.exceptions.ComputeError,
+            pl.exceptions.SchemaError, pl.exceptions.ShapeError,
+            pl.exceptions.NoDataError)
+
+
+def read_extract_table(key, source, backend=None):
+    #--------------------------------------------------------------------------
+    # parse one extract file with the csv_backend; the bulk readers need
+    # regular rows, files with short or long rows (which the stdlib reader
+    # pads or cuts) are read with the stdlib reader
+    backend = backend or csv_backend
+    if backend != 'stdlib':
+        try:
+            return csv_backends[backend](key, source)
+        except csv_backend_errors as e:
+            print('\tWARNING: {} failed on {} ({}), using the stdlib csv '
+                    'reader'.format(backend, source[1], e))
+    return read_extract_stdlib(key, source)
+
+
+def csv_backend_available(backend):
+    if backend == 'pyarrow':
+        return pa is not None
+    elif backend == 'polars':
+        return pl is not None
+    return backend in csv_backends
+
+
+def csv_backend_parity(prod_status, backends=None):
+    #--------------------------------------------------------------------------
+    # read every extract file of a product status with the stdlib reader and
+    # with each other installed backend, without the stdlib fallback of
+    # read_extract_table, and report the tables where the records differ or
+    # the backend fails; returns True when all of them are the same
+    sources = extract_sources(prod_status)
+    backends = [backend for backend in backends or csv_backends
+            if backend != 'stdlib' and csv_backend_available(backend)]
+    same = True
+    for key in worksheet:
+        source = sources.get(extract_file_name(worksheet[key]['input'],
+            suffixes[prod_status]))
+        if source is None:
+            continue
+        expected = read_extract_stdlib(key, source)
+        if not expected:
+            # an empty file has no columns, it is always read with the
+            # stdlib reader
+            continue
+        for backend in backends:
+            try:
+                records = csv_backends[backend](key, source)
+            except csv_backend_errors as e:
+                print('\tERROR: {} failed on {} ({})'.format(backend, key, e))
+                same = False
+                continue
+            if records != expected:
+                mismatch = next((n for n in range(min(len(records),
+                    len(expected))) if records[n] != expected[n]),
+                    min(len(records), len(expected)))
+                print('\tERROR: {} {} differs from stdlib at row {} '
+                        '({} / {} rows)'.format(backend, key, mismatch,
+                            len(records), len(expected)))
+                same = False
+            else:
+                print('  {} {} {} rows match'.format(backend, key,
+                    len(records)))
+    return same
+
+
+def load_dpd_extracts(prod_status, jobs=1):
+    #--------------------------------------------------------------------------
+    # load dpd extracts
+    suffix = suffixes[prod_status]
+    sources = extract_sources(prod_status)
 
-        if not os.path.isfile(fname):
+    # check every file before reading any of them
+    missing = []
+    for key in worksheet:
+        fname = extract_file_name(worksheet[key]['input'], suffix)
+        if fname not in sources:
+            missing.append(fname)
+    if missing:
+        for fname in missing:
             print('\tERROR: file not found {}'.format(fname))
-            return False
+        return False
 
-        with open(fname) as csvfile:
-            csv_data = csv.DictReader(csvfile, worksheet[key]['fields'])
-            output = []
-            for row in csv_data:
-                # DPD data fields are not consistent
-                row['upc'] = ''
-                row['packaging'] = ''
-                row['packaging_f'] = ''
-                row['pharmaceutical_std'] = ''
-                output.append(row)
+    keys = list(worksheet)
+    table_sources = [sources[extract_file_name(worksheet[key]['input'],
+        suffix)] for key in keys]
+
+    backend = csv_backend
+    if not csv_backend_available(backend):
+        print('\tERROR: {} is not installed, using the stdlib csv '
+                'reader'.format(backend))
+        backend = 'stdlib'
+    backends = [backend] * len(keys)
+
+    # the tables are independent: parse them in worker processes, the load
+    # then takes about as long as the largest file
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(keys))) as executor:
+            outputs = list(executor.map(read_extract_table, keys,
+                table_sources, backends))
+    else:
+        outputs = [read_extract_table(key, source, backend)
+                for key, source in zip(keys, table_sources)]
 
-            worksheet[key]['output'] = output
+    for key, output in zip(keys, outputs):
+        worksheet[key]['output'] = output
 
     print('...total {} drug data loaded'.format(
         len(worksheet['drug_product']['output'])))
     return True
 
 
-def build_worksheet(prod_status):
+def group_by_drug_code(rows):
     #--------------------------------------------------------------------------
-    # build worksheet
-    if worksheet['drug_product']['output'] == []:
-        input('\tERROR: No data found...read raw data first')
-        return False
+    # index table rows by drug_code, keeping the order of the extract file
+    groups = {}
+    for row in rows:
+        code = row.drug_code
+        if code in groups:
+            groups[code].append(row)
+        else:
+            groups[code] = [row]
+    return groups
 
-    # take drug_product dict as base set
-    drug_l = worksheet['drug_product']['output']
 
+@functools.lru_cache(maxsize=1 << 16)
+def iso_date(value):
+    # DPD date (02-JUL-2021) as a sortable ISO date (2021-07-02), '' if none;
+    # the same few thousand dates repeat, so they are parsed once
+    try:
+        return datetime.strptime(value, '%d-%b-%Y').strftime('%Y-%m-%d')
+    except (TypeError, ValueError):
+        return ''
+
+
+def merge_drugs(drug_l, groups, verbose=True):
+    #--------------------------------------------------------------------------
+    # merge the grouped child tables into the drug records; every drug
+    # record is replaced by its merged dict
+    drug_names = worksheet['drug_product']['names']
+    progress = Progress('...', len(drug_l), verbose)
     for idx in range(len(drug_l)):
-        print("... {}/{}".format(idx,len(drug_l)), end="\r", flush=True)
+        progress.update(idx)
+        drug = dict(zip(drug_names, drug_l[idx]))
+        drug_l[idx] = drug
+        code = drug['drug_code']
+
         # fill brand_name_f if not exist
-        if drug_l[idx]['brand_name_f'] == '':
-            drug_l[idx]['brand_name_f'] = drug_l[idx]['brand_name']
+        if drug['brand_name_f'] == '':
+            drug['brand_name_f'] = drug['brand_name']
 
         # active ingredients
-        ingred_l = worksheet['active_ingredients']['output']
-        drug_l[idx]['ingredients'] = []
-        drug_l[idx]['ingredients_f'] = []
-        for idy in range(len(ingred_l)):
-            if drug_l[idx]['drug_code'] == ingred_l[idy]['drug_code']:
-                drug_l[idx]['ingredients'].append(
-                    ingred_l[idy]['ingredients'] + ' ' +
-                    ingred_l[idy]['strength'] +
-                    ingred_l[idy]['strength_unit'])
-                drug_l[idx]['ingredients_f'].append(
-                    ingred_l[idy]['ingredients_f'] + ' ' +
-                    ingred_l[idy]['strength'] +
-                    ingred_l[idy]['strength_unit_f'])
-
-        # company name and code
-        company_l = worksheet['companies']['output']
-        for idy in range(len(company_l)):
-            if drug_l[idx]['drug_code'] == company_l[idy]['drug_code']:
-                drug_l[idx]['company_name'] = company_l[idy]['company_name']
-                drug_l[idx]['company_code'] = company_l[idy]['company_code']
+        drug['ingredients'] = []
+        drug['ingredients_f'] = []
+        for row in groups['active_ingredients'].get(code, ()):
+            drug['ingredients'].append(
+                row.ingredients + ' ' + row.strength +
+                row.strength_unit)
+            drug['ingredients_f'].append(
+                row.ingredients_f + ' ' + row.strength +
+                row.strength_unit_f)
+
+        # company name and code (last match wins)
+        for row in groups['companies'].get(code, ()):
+            drug['company_name'] = row.company_name
+            drug['company_code'] = row.company_code
 
         # dosage form
-        dosage_l = worksheet['dosage_form']['output']
-        drug_l[idx]['dosage_form'] = []
-        drug_l[idx]['dosage_form_f'] = []
-        for idy in range(len(dosage_l)):
-            if drug_l[idx]['drug_code'] == dosage_l[idy]['drug_code']:
-                drug_l[idx]['dosage_form'].append(
-                        dosage_l[idy]['pharmaceutical_form'])
-                drug_l[idx]['dosage_form_f'].append(
-                        dosage_l[idy]['pharmaceutical_form_f'])
+        drug['dosage_form'] = []
+        drug['dosage_form_f'] = []
+        for row in groups['dosage_form'].get(code, ()):
+            drug['dosage_form'].append(row.pharmaceutical_form)
+            drug['dosage_form_f'].append(row.pharmaceutical_form_f)
 
         '''
         # packaging (no meaningful entries at the moment)
-        packaging_l = worksheet['packaging']['output']
-        for idy in range(len(packaging_l)):
-            if drug_l[idx]['drug_code'] == packaging_l[idy]['drug_code']:
-                drug_l[idx]['upc'] = packaging_l[idy]['upc']
-                drug_l[idx]['packaging'] = (
-                        packaging_l[idy]['package_type'] + '' +
-                        packaging_l[idy]['package_size'] +
-                        packaging_l[idy]['package_size_unit'])
-                drug_l[idx]['packaging_f'] = (
-                        packaging_l[idy]['package_type_f'] + '' +
-                        packaging_l[idy]['package_size'] +
-                        packaging_l[idy]['package_size_unit_f'])
+        for row in groups['packaging'].get(code, ()):
+            drug['upc'] = row.upc
+            drug['packaging'] = (row.package_type + '' +
+                    row.package_size + row.package_size_unit)
+            drug['packaging_f'] = (row.package_type_f + '' +
+                    row.package_size + row.package_size_unit_f)
         '''
 
-        # packaging (replace with product_information)
-        packaging_l = worksheet['packaging']['output']
-        for idy in range(len(packaging_l)):
-            if drug_l[idx]['drug_code'] == packaging_l[idy]['drug_code']:
-                drug_l[idx]['upc'] = packaging_l[idy]['upc']
-                drug_l[idx]['packaging'] = packaging_l[idy]['product_information']
-                drug_l[idx]['packaging_f'] = packaging_l[idy]['product_information']
+        # packaging (replace with product_information, last match wins)
+        for row in groups['packaging'].get(code, ()):
+            drug['upc'] = row.upc
+            drug['packaging'] = row.product_information
+            drug['packaging_f'] = row.product_information
 
-        # phamaceutical standard
-        pharm_l = worksheet['pharmaceutical_standard']['output']
-        for idy in range(len(pharm_l)):
-            if drug_l[idx]['drug_code'] == pharm_l[idy]['drug_code']:
-                drug_l[idx]['pharmaceutical_std'] = pharm_l[idy]['pharmaceutical_std']
+        # phamaceutical standard (last match wins)
+        for row in groups['pharmaceutical_standard'].get(code, ()):
+            drug['pharmaceutical_std'] = row.pharmaceutical_std
 
         # route of administration
-        route_l = worksheet['route_of_administration']['output']
-        drug_l[idx]['admin_route'] = []
-        drug_l[idx]['admin_route_f'] = []
-        for idy in range(len(route_l)):
-            if drug_l[idx]['drug_code'] == route_l[idy]['drug_code']:
-                drug_l[idx]['admin_route'].append(
-                        route_l[idy]['route_of_administration'])
-                drug_l[idx]['admin_route_f'].append(
-                        route_l[idy]['route_of_administration_f'])
+        drug['admin_route'] = []
+        drug['admin_route_f'] = []
+        for row in groups['route_of_administration'].get(code, ()):
+            drug['admin_route'].append(row.route_of_administration)
+            drug['admin_route_f'].append(row.route_of_administration_f)
 
         # schedule
-        schedule_l = worksheet['schedule']['output']
-        drug_l[idx]['schedule'] = []
-        drug_l[idx]['schedule_f'] = []
-        for idy in range(len(schedule_l)):
-            if drug_l[idx]['drug_code'] == schedule_l[idy]['drug_code']:
-                drug_l[idx]['schedule'].append(
-                        schedule_l[idy]['schedule'])
-                drug_l[idx]['schedule_f'].append(
-                        schedule_l[idy]['schedule_f'])
-
-        # product status
-        status_l = worksheet['product_status']['output']
-        for idy in range(len(status_l)):
-            if drug_l[idx]['drug_code'] == status_l[idy]['drug_code']:
-                # only care current status
-                if status_l[idy]['current_status_flag'] == 'Y':
-                    drug_l[idx]['status'] = status_l[idy]['status']
-                    drug_l[idx]['status_f'] = status_l[idy]['status_f']
-
-        # therapeutic class (can be skipped)
-        ther_l = worksheet['therapeutic_class']['output']
-        for idy in range(len(ther_l)):
-            if drug_l[idx]['drug_code'] == ther_l[idy]['drug_code']:
-                drug_l[idx]['tc_atc'] = ther_l[idy]['tc_atc']
-                drug_l[idx]['tc_atc_f'] = ther_l[idy]['tc_atc_f']
-                drug_l[idx]['tc_ahfs'] = ther_l[idy]['tc_ahfs']
-                drug_l[idx]['tc_ahfs_f'] = ther_l[idy]['tc_ahfs_f']
+        drug['schedule'] = []
+        drug['schedule_f'] = []
+        for row in groups['schedule'].get(code, ()):
+            drug['schedule'].append(row.schedule)
+            drug['schedule_f'].append(row.schedule_f)
+
+        # product status (current status, last match wins), and the full
+        # status history ordered by date
+        history = []
+        for row in groups['product_status'].get(code, ()):
+            if row.current_status_flag == 'Y':
+                drug['status'] = row.status
+                drug['status_f'] = row.status_f
+            history.append({'status': row.status, 'status_f': row.status_f,
+                'history_date': iso_date(row.history_date),
+                'current_status_flag': row.current_status_flag,
+                'lot_number': row.lot_number,
+                'expiration_date': iso_date(row.expiration_date)})
+        history.sort(key=lambda entry: entry['history_date'])
+
+        # therapeutic class (can be skipped, last match wins)
+        for row in groups['therapeutic_class'].get(code, ()):
+            drug['tc_atc'] = row.tc_atc
+            drug['tc_atc_f'] = row.tc_atc_f
+            drug['tc_ahfs'] = row.tc_ahfs
+            drug['tc_ahfs_f'] = row.tc_ahfs_f
 
         # veterinary species
-        species_l = worksheet['veterinary_species']['output']
-        drug_l[idx]['vet_species'] = []
-        drug_l[idx]['vet_species_f'] = []
-        for idy in range(len(species_l)):
-            if drug_l[idx]['drug_code'] == species_l[idy]['drug_code']:
-                drug_l[idx]['vet_species'].append(
-                        species_l[idy]['vet_species'] + '' +
-                        species_l[idy]['vet_sub_species'])
-                drug_l[idx]['vet_species_f'].append(
-                        species_l[idy]['vet_species_f'])
+        drug['vet_species'] = []
+        drug['vet_species_f'] = []
+        for row in groups['veterinary_species'].get(code, ()):
+            drug['vet_species'].append(
+                    row.vet_species + '' + row.vet_sub_species)
+            drug['vet_species_f'].append(row.vet_species_f)
+
+        # build only fields: the status history, and the active ingredients
+        # with the ingredient code, strength and dosage kept apart
+        drug['status_history'] = history
+        drug['active_ingredients'] = []
+        for row in groups['active_ingredients'].get(code, ()):
+            drug['active_ingredients'].append({
+                'ingredient': row.ingredients,
+                'ingredient_f': row.ingredients_f,
+                'strength': row.strength,
+                'strength_unit': row.strength_unit,
+                'strength_unit_f': row.strength_unit_f,
+                'active_ingredient_code': row.active_ingredient_code,
+                'dosage_value': row.dosage_value,
+                'dosage_unit': row.dosage_unit})
+
+    progress.done()
+    return drug_l
+
+
+def drug_code_digests(groups):
+    #--------------------------------------------------------------------------
+    # digest of the loaded rows of every drug_code, per worksheet table
+    digests = {}
+    for key in groups:
+        digests[key] = {}
+        for code, rows in groups[key].items():
+            digests[key][code] = hashlib.blake2b(repr(rows).encode(),
+                    digest_size=8).hexdigest()
+    return digests
+
+
+def changed_drug_codes(old_digests, digests):
+    # drug codes whose rows differ in any table
+    changed = set()
+    for key in digests:
+        old = old_digests.get(key, {})
+        new = digests[key]
+        for code in new:
+            if old.get(code) != new[code]:
+                changed.add(code)
+        for code in old:
+            if code not in new:
+                changed.add(code)
+    return changed
+
+
+def load_previous_build(prod_status):
+    # previous build data and its drug_code digests, if usable
+    fname = build_file_name(prod_status, '.codes')
+    if not os.path.isfile(fname) or not os.path.isfile(
+            build_file_name(prod_status)):
+        return None
+    try:
+        with open(fname) as f:
+            codes = json.load(f)
+        if codes['version'] != build_format_version:
+            return None
+        return BuildStore(build_file_name(prod_status)), codes['digests']
+    except:
+        return None
+
+
+def build_worksheet(prod_status, incremental=False):
+    #--------------------------------------------------------------------------
+    # build worksheet; False when there is no drug to build, the caller
+    # reports it (no prompt here, the build also runs headless)
+    if worksheet['drug_product']['output'] == []:
+        print('\tERROR: No data found...read raw data first')
+        return False
+
+    # take drug_product dict as base set
+    drug_l = worksheet['drug_product']['output']
+
+    # group every table by drug_code once instead of scanning each table for
+    # every drug
+    groups = {}
+    for key in worksheet:
+        groups[key] = group_by_drug_code(worksheet[key]['output'])
+    digests = drug_code_digests(groups)
+    del groups['drug_product']
+
+    # with a previous build, only the drugs whose rows changed in any table
+    # are merged again; the others are taken from the previous build data
+    previous = None
+    if incremental:
+        previous = load_previous_build(prod_status)
+
+    if previous is None:
+        merge_drugs(drug_l, groups)
+    else:
+        store, old_digests = previous
+        changed = changed_drug_codes(old_digests, digests)
+        merge_idx = [idx for idx in range(len(drug_l))
+                if drug_l[idx].drug_code in changed]
+        print('... {} of {} drugs changed'.format(len(merge_idx), len(drug_l)))
+
+        merged = merge_drugs([drug_l[idx] for idx in merge_idx], groups)
+        for idx in range(len(merge_idx)):
+            drug_l[merge_idx[idx]] = merged[idx]
+
+        taken = {}
+        for idx in range(len(drug_l)):
+            if not isinstance(drug_l[idx], dict):
+                code = drug_l[idx].drug_code
+                taken[code] = taken.get(code, 0) + 1
+                drug_l[idx] = store[store.lookup('drug_code',
+                    code)[taken[code] - 1]]
+        store.close()
 
     #--------------------------------------------------------------------------
-    # save worksheet in json format
-    fname = build_prefix + '_' + prod_status + '.json'
-    json.dump(worksheet['drug_product']['output'], open(fname, 'w'))
+    # save worksheet in binary format, and in json format if asked
+    # the digests are removed before the build file is replaced and written
+    # after it, so they never describe another build (without them the
+    # next build is a full one); the manifest is saved by the caller last
+    fname = build_file_name(prod_status)
+    codes = build_file_name(prod_status, '.codes')
+    write_build_store(fname + '.tmp', drug_l)
+    if os.path.isfile(codes):
+        os.remove(codes)
+    os.replace(fname + '.tmp', fname)
+    with open(codes + '.tmp', 'w') as f:
+        json.dump({'version': build_format_version, 'digests': digests}, f)
+    os.replace(codes + '.tmp', codes)
+    if build_json:
+        with open_json_output(build_file_name(prod_status, '.json')) as f:
+            write_json_list(f, drug_l)
+    return True
+
+
+def encode_key(value):
+    # index key as bytes; a missing DIN sorts after every key
+    return b'\xff' if value is None else value.encode('utf-8')
+
+
+def decode_key(key):
+    return None if key == b'\xff' else key.decode('utf-8')
+
+
+def write_array(f, values):
+    # array of unsigned 64 bit integers, little endian
+    values = array('Q', values)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    values.tofile(f)
+
+
+def write_build_store(fname, drugs):
+    #--------------------------------------------------------------------------
+    # binary build file: header, records as utf-8 json, record offsets, and
+    # for DIN and drug_code a key index sorted by key: number of entries,
+    # key offsets, record numbers and the keys. Nothing in the file is
+    # executed when it is read (no pickle), only json and integers
+    offsets = array('Q')
+    entries = dict((name, []) for name, field in build_index_keys)
+
+    with open(fname, 'wb') as f:
+        f.write(b'\0' * build_header.size)
+        for drug in drugs:
+            idx = len(offsets)
+            offsets.append(f.tell())
+            f.write(json.dumps(drug, ensure_ascii=False,
+                separators=(',', ':')).encode('utf-8'))
+            for name, field in build_index_keys:
+                entries[name].append((encode_key(drug[field]), idx))
+        count = len(offsets)
+        offsets.append(f.tell())
+        write_array(f, offsets)
+
+        index_at = []
+        for name, field in build_index_keys:
+            index_at.append(f.tell())
+            entries[name].sort()
+            keys = array('Q', [0])
+            for key, idx in entries[name]:
+                keys.append(keys[-1] + len(key))
+            f.write(struct.pack('<Q', len(entries[name])))
+            write_array(f, keys)
+            write_array(f, [idx for key, idx in entries[name]])
+            for key, idx in entries[name]:
+                f.write(key)
+
+        f.seek(0)
+        f.write(build_header.pack(build_magic, count, offsets[count],
+            *index_at))
+
+
+class KeyIndex:
+    #--------------------------------------------------------------------------
+    # sorted key index of a build file, read in place from the memory map:
+    # a lookup bisects the keys, so only a few of them are ever read
+    def __init__(self, mm, at):
+        self.mm = mm
+        self.count = struct.unpack_from('<Q', mm, at)[0]
+        self.keys_at = at + 8
+        self.idxs_at = self.keys_at + 8 * (self.count + 1)
+        self.blob_at = self.idxs_at + 8 * self.count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, n):
+        # key bytes of entry n
+        start, end = struct.unpack_from('<QQ', self.mm, self.keys_at + 8 * n)
+        return self.mm[self.blob_at + start:self.blob_at + end]
+
+    def record(self, n):
+        return struct.unpack_from('<Q', self.mm, self.idxs_at + 8 * n)[0]
+
+    def lookup(self, value):
+        # record numbers of a key, in build order
+        key = encode_key(value)
+        n = bisect_left(self, key)
+        idxs = []
+        while n < self.count and self[n] == key:
+            idxs.append(self.record(n))
+            n += 1
+        return idxs
+
+    def items(self):
+        # {key: record numbers} of the whole index
+        index = {}
+        for n in range(self.count):
+            index.setdefault(decode_key(self[n]), []).append(self.record(n))
+        return index
+
+
+class BuildStore:
+    #--------------------------------------------------------------------------
+    # read-only view of a binary build file; the file is memory mapped and
+    # records are only decoded when accessed
+    def __init__(self, fname):
+        self.fname = fname
+        self.file = open(fname, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, offsets_at, *index_at = \
+                build_header.unpack_from(self.mm, 0)
+        if magic != build_magic:
+            self.close()
+            raise ValueError('not a build file: {}'.format(fname))
+
+        self.offsets = array('Q')
+        self.offsets.frombytes(self.mm[offsets_at:offsets_at +
+            8 * (self.count + 1)])
+        if sys.byteorder != 'little':
+            self.offsets.byteswap()
+        self.indexes = {}
+        for (name, field), at in zip(build_index_keys, index_at):
+            self.indexes[name] = KeyIndex(self.mm, at)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self.count
+        if idx < 0 or idx >= self.count:
+            raise IndexError('build record out of range')
+        return json.loads(self.mm[self.offsets[idx]:self.offsets[idx + 1]])
+
+    def __iter__(self):
+        for idx in range(self.count):
+            yield self[idx]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def index_of(self, key):
+        # {DIN: record numbers} for 'din', {drug_code: ...} for 'drug_code'
+        return self.indexes[key].items()
+
+    def lookup(self, key, value):
+        # record numbers for a DIN ('din') or a drug_code ('drug_code')
+        return self.indexes[key].lookup(value)
+
+    def by_din(self, din):
+        return [self[idx] for idx in self.lookup('din', din)]
+
+    def by_drug_code(self, code):
+        return [self[idx] for idx in self.lookup('drug_code', code)]
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+
+def build_file_name(prod_status, ext=build_ext):
+    return build_prefix + '_' + prod_status + ext
+
+
+def json_file_name(fname):
+    # name of a json output, compressed if asked
+    if json_gzip:
+        return fname + '.gz'
+    return fname
+
+
+def open_json_output(fname):
+    if json_gzip:
+        return gzip.open(json_file_name(fname), 'wt', encoding='utf-8')
+    return open(fname, 'w')
+
+
+def write_json_list(f, records):
+    #--------------------------------------------------------------------------
+    # write a json list one record at a time; same output as json.dump
+    f.write('[')
+    first = True
+    for record in records:
+        if not first:
+            f.write(', ')
+        first = False
+        f.write(json.dumps(record))
+    f.write(']')
+
+
+def write_json_dict(f, items):
+    #--------------------------------------------------------------------------
+    # write a json object one (key, value) pair at a time; same output as
+    # json.dump
+    f.write('{')
+    first = True
+    for key, value in items:
+        if not first:
+            f.write(', ')
+        first = False
+        if key is None:
+            key = 'null'
+        f.write(json.dumps(key))
+        f.write(': ')
+        f.write(json.dumps(value))
+    f.write('}')
+
+
+def build_store_to_json(prod_status):
+    #--------------------------------------------------------------------------
+    # convert the binary build file of a status to build_<STATUS>.json
+    with BuildStore(build_file_name(prod_status)) as store:
+        with open_json_output(build_file_name(prod_status, '.json')) as f:
+            write_json_list(f, store)
+
+
+def build_json_to_store(prod_status):
+    #--------------------------------------------------------------------------
+    # convert build_<STATUS>.json to the binary build file
+    with open(build_file_name(prod_status, '.json')) as f:
+        drugs = json.load(f)
+    write_build_store(build_file_name(prod_status), drugs)
 
 
 def load_build_data(prod_status):
-    fname = build_prefix + '_' + prod_status + '.json'
+    fname = build_file_name(prod_status)
     try:
-        drugs = json.load(open(fname))
+        # build data from older versions only exists in json format
+        if (not os.path.isfile(fname) and
+                os.path.isfile(build_file_name(prod_status, '.json'))):
+            build_json_to_store(prod_status)
+        drugs = BuildStore(fname)
     except:
-        print('ERROR: failed to load JSON data({})...'.format(fname))
+        print('ERROR: failed to load build data({})...'.format(fname))
         return None
     else:
         return drugs
@@ -323,140 +1110,1418 @@ def load_build_data(prod_status):
 	vet_species: []
 	vet_species_f: []
 '''
-def create_sqlite_database(drug_data, prod_status, option=None):
+def output_name(prod_status, option=None):
+    # output file name (without extension) for a schedule option
+    if option in output_prefixes:
+        return output_prefixes[option] + prod_status
+    return output_prefixes['ALL'] + prod_status
 
+
+def classify_drug(drug):
+    #--------------------------------------------------------------------------
+    # evaluate the OTC and prescription rules once per drug
+    human = 'Human' in drug['class']
+    otc = (human and
+            'CAT IV' not in drug['product_categorization'] and
+            otc_excluded_forms.isdisjoint(drug['dosage_form']) and
+            'OTC' in drug['schedule'])
+    prs = human and 'Prescription' in drug['schedule']
+    return otc, prs
+
+
+def option_selects(option, otc, prs):
+    # whether a drug classified as (otc, prs) belongs to the option output
     if option == 'OTC':
-        outfilename = 'otc_' + prod_status
+        return otc
     elif option == 'PRS':
-        outfilename = 'prs_' + prod_status
+        return prs
     elif option == 'OTC+PRS':
-        outfilename = 'drugs_' + prod_status
-    else:
-        outfilename = 'all_' + prod_status
+        return otc or prs
+    return True
 
-    # sqlite3 format
-    dbname = outfilename + '.sql3'
-    # json format to be used with firebase storage
-    fbname = outfilename + '.json'
-    fbdict = {}
 
-    # delete existing sqlite3 files if any
-    if os.path.isfile(dbname):
-        os.remove(dbname)
+# columns of the drugs table, in the order of sqlite_row
+drugs_columns = ['id', 'drug_code', 'status', 'status_f', 'company_name',
+        'company_code', 'ph_std', 'packaging', 'packaging_f', 'upc',
+        'category', 'class', 'class_f', 'brand_name', 'brand_name_f',
+        'ingredients', 'ingredients_f', 'dosage_form', 'dosage_form_f',
+        'admin_route', 'admin_route_f', 'schedule', 'schedule_f',
+        'descriptor', 'descriptor_f']
+
+# dictionary encoded drugs table columns of the dict output, by lookup name
+sqlite_dict_columns = {
+    'status': ['status', 'status_f'],
+    'company': ['company_name', 'company_code'],
+    'ph_std': ['ph_std'],
+    'category': ['category'],
+    'class': ['class', 'class_f'],
+    'dosage_form': ['dosage_form', 'dosage_form_f'],
+    'admin_route': ['admin_route', 'admin_route_f'],
+    'schedule': ['schedule', 'schedule_f'],
+}
 
-    #
-    # create sqlite3 database
-    #
-    con = sqlite3.connect(dbname)
-    # get cursor
-    cursor = con.cursor()
-    # create schema
-    cursor.execute("CREATE TABLE drugs ("
-        "id TEXT, drug_code TEXT, status TEXT, status_f TEXT,"
-        "company_name TEXT, company_code TEXT, ph_std TEXT, packaging TEXT,"
-        "packaging_f TEXT, upc TEXT, category TEXT, class TEXT,"
-        "class_f TEXT, brand_name TEXT, brand_name_f TEXT, ingredients TEXT,"
-        "ingredients_f TEXT, dosage_form TEXT, dosage_form_f TEXT, admin_route TEXT,"
-        "admin_route_f TEXT,schedule TEXT, schedule_f TEXT, descriptor TEXT,"
-        "descriptor_f TEXT)")
-
-    drug_id = -1
-    ingredients = ''
-
-    # insert data
-    for idx in range(len(drug_data)):
-        print("...processing {}/{}".format(idx,len(drug_data)), end="\r", flush=True)
-        # DPD extract has potentially duplicated entries with the same drug id
-        # We remove those here on the assumption that those are listed next to
-        # each other. However this assumption may not be true.
-        if drug_id == drug_data[idx]['drug_identification_number']:
-            continue
+# dictionary encoded record fields of the dict_json output, by lookup name
+json_dict_fields = {
+    'status': ['status', 'status_f'],
+    'company': ['company_name', 'company_code'],
+    'category': ['product_categorization'],
+    'class': ['class', 'class_f'],
+    'dosage_form': ['dosage_form', 'dosage_form_f'],
+    'admin_route': ['admin_route', 'admin_route_f'],
+    'schedule': ['schedule', 'schedule_f'],
+}
+
+
+def sqlite_row(drug):
+    # values of a drug record in the column order of the drugs table
+    return (
+        drug['drug_identification_number'],
+        drug['drug_code'],
+        drug['status'],
+        drug['status_f'],
+        #
+        drug['company_name'],
+        drug['company_code'],
+        drug['pharmaceutical_std'],
+        drug['packaging'],
+        #
+        drug['packaging_f'],
+        drug['upc'],
+        drug['product_categorization'],
+        drug['class'],
+        #
+        drug['class_f'],
+        drug['brand_name'],
+        drug['brand_name_f'],
+        ','.join(drug['ingredients']),
+        #
+        ','.join(drug['ingredients_f']),
+        ','.join(drug['dosage_form']),
+        ','.join(drug['dosage_form_f']),
+        ','.join(drug['admin_route']),
+        #
+        ','.join(drug['admin_route_f']),
+        ','.join(drug['schedule']),
+        ','.join(drug['schedule_f']),
+        drug['descriptor'],
+        #
+        drug['descriptor_f'])
+
+
+class SqliteSink:
+    #--------------------------------------------------------------------------
+    # sqlite3 output: bulk loaded drugs table
+    def __init__(self, outfilename, drug_data):
+        self.dbname = outfilename + '.sql3'
+
+        # delete existing sqlite3 files if any
+        if os.path.isfile(self.dbname):
+            os.remove(self.dbname)
+
+        self.con = sqlite3.connect(self.dbname)
+        self.cursor = self.con.cursor()
+        # load-time settings: the file is rebuilt from scratch on failure, so
+        # there is no need for a rollback journal or fsync
+        for pragma in sqlite_load_pragmas:
+            self.cursor.execute('PRAGMA ' + pragma)
+        # create schema
+        self.cursor.execute("CREATE TABLE drugs ("
+            "id TEXT, drug_code TEXT, status TEXT, status_f TEXT,"
+            "company_name TEXT, company_code TEXT, ph_std TEXT, packaging TEXT,"
+            "packaging_f TEXT, upc TEXT, category TEXT, class TEXT,"
+            "class_f TEXT, brand_name TEXT, brand_name_f TEXT, ingredients TEXT,"
+            "ingredients_f TEXT, dosage_form TEXT, dosage_form_f TEXT, admin_route TEXT,"
+            "admin_route_f TEXT,schedule TEXT, schedule_f TEXT, descriptor TEXT,"
+            "descriptor_f TEXT)")
+
+        # parameterized insert, batched in a single transaction
+        self.insert_sql = 'INSERT INTO drugs VALUES ({})'.format(
+                ','.join(['?'] * 25))
+        self.rows = []
+
+    @staticmethod
+    def outputs(outfilename):
+        return [outfilename + '.sql3']
+
+    def add(self, idx, drug, row):
+        self.rows.append(row)
+        if len(self.rows) >= sqlite_batch_size:
+            self.cursor.executemany(self.insert_sql, self.rows)
+            self.rows = []
+
+    def close(self):
+        if self.rows:
+            self.cursor.executemany(self.insert_sql, self.rows)
+            self.rows = []
+        self.con.commit()
+
+        # build the indexes after the data is in, which is much cheaper than
+        # maintaining them row by row
+        for column in sqlite_index_columns:
+            self.cursor.execute(
+                    'CREATE INDEX drugs_{0} ON drugs ({0})'.format(column))
+        self.con.commit()
+        self.con.close()
+
+        '''
+        # create archive from the sql3 file
+        shutil.make_archive(outfilename, 'zip', '.', dbname)
+        '''
+
+
+def firebase_record(drug):
+    # drug record as published in the firebase json output
+    return {key: value for key, value in drug.items()
+            if key not in build_only_fields}
+
+
+class FirebaseSink:
+    #--------------------------------------------------------------------------
+    # json output with drug id as key, to be used with firebase storage;
+    # only the record number of each DIN is kept until the records are
+    # streamed out from the build data
+    def __init__(self, outfilename, drug_data):
+        self.fbname = outfilename + '.json'
+        self.drug_data = drug_data
+        self.fbkeys = {}
+
+    @staticmethod
+    def outputs(outfilename):
+        return [json_file_name(outfilename + '.json')]
+
+    def add(self, idx, drug, row):
+        # duplicated DINs are resolved before the export, each DIN is added
+        # once
+        self.fbkeys[drug['drug_identification_number']] = idx
+
+    def close(self):
+        with open_json_output(self.fbname) as f:
+            write_json_dict(f, ((din, firebase_record(self.drug_data[idx]))
+                for din, idx in self.fbkeys.items()))
+
+
+class FirebaseShardSink(FirebaseSink):
+    #--------------------------------------------------------------------------
+    # firebase json output split into shards of at most fb_shard_bytes,
+    # partitioned by DIN prefix, with a manifest of the shard key ranges:
+    #   <output>.shards/<output>_<first prefix>-<last prefix>.json
+    #   <output>.shards/manifest.json
+    def __init__(self, outfilename, drug_data):
+        FirebaseSink.__init__(self, outfilename, drug_data)
+        self.outfilename = outfilename
+        self.shard_dir = outfilename + '.shards'
+
+    @staticmethod
+    def outputs(outfilename):
+        return [outfilename + '.shards/manifest.json']
+
+    def partition(self, dins, sizes, length):
+        # pack consecutive DIN prefix groups into shards under the size
+        # limit; groups too large for one shard are split on a longer prefix
+        groups = []
+        for din in dins:
+            prefix = din[:length]
+            if groups and groups[-1][0] == prefix:
+                groups[-1][1].append(din)
+            else:
+                groups.append((prefix, [din]))
+
+        shards = []
+        current = None
+        for prefix, group in groups:
+            size = sum(sizes[din] for din in group)
+            if size > fb_shard_bytes and len(group) > 1 and length < max(
+                    len(din) for din in group):
+                current = None
+                shards.extend(self.partition(group, sizes, length + 1))
+            elif current is not None and current['bytes'] + size <= fb_shard_bytes:
+                current['last_prefix'] = prefix
+                current['dins'].extend(group)
+                current['bytes'] += size
+            else:
+                if size > fb_shard_bytes:
+                    print('\tWARNING: shard {} is over {} bytes'.format(
+                        prefix, fb_shard_bytes))
+                current = {'first_prefix': prefix, 'last_prefix': prefix,
+                        'dins': list(group), 'bytes': size}
+                shards.append(current)
+        return shards
+
+    def entry(self, key):
+        # one "din": {...} entry of the json object, utf-8 encoded
+        return '{}: {}'.format(json.dumps(key), json.dumps(firebase_record(
+            self.drug_data[self.fbkeys[self.dins[key]]]))).encode()
+
+    def close(self):
+        # json key of each DIN, a missing DIN becomes "null" as in json.dump
+        self.dins = {}
+        for din in self.fbkeys:
+            self.dins['null' if din is None else din] = din
+
+        # DPD DINs are numeric strings of the same length, so string order
+        # is key order in firebase as well. Each entry is encoded once into
+        # a spool file; its size (with the ', ' separator) places it in a
+        # shard and its offset copies it into the shard file
+        keys = sorted(self.dins)
+        spool = tempfile.TemporaryFile(dir=os.path.dirname(self.fbname) or '.')
+        sizes = {}
+        offsets = {}
+        for key in keys:
+            entry = self.entry(key)
+            offsets[key] = spool.tell()
+            sizes[key] = len(entry) + 2
+            spool.write(entry)
+        shards = self.partition(keys, sizes, fb_shard_prefix_len)
+
+        os.makedirs(self.shard_dir, exist_ok=True)
+        manifest = {'source': os.path.basename(self.fbname),
+                'max_bytes': fb_shard_bytes,
+                'shards': []}
+        for shard in shards:
+            fname = '{}_{}-{}.json'.format(
+                    os.path.basename(self.outfilename),
+                    shard['first_prefix'], shard['last_prefix'])
+            digest = hashlib.sha256()
+            with open(self.shard_dir + '/' + fname, 'wb') as f:
+                f.write(b'{')
+                for n in range(len(shard['dins'])):
+                    key = shard['dins'][n]
+                    spool.seek(offsets[key])
+                    entry = spool.read(sizes[key] - 2)
+                    if n > 0:
+                        f.write(b', ')
+                        digest.update(b', ')
+                    f.write(entry)
+                    digest.update(entry)
+                f.write(b'}')
+            manifest['shards'].append({'file': fname,
+                'first': shard['dins'][0], 'last': shard['dins'][-1],
+                'first_prefix': shard['first_prefix'],
+                'last_prefix': shard['last_prefix'],
+                'count': len(shard['dins']),
+                'bytes': os.path.getsize(self.shard_dir + '/' + fname),
+                'sha256': digest.hexdigest()})
+
+        # remove shards left over from an earlier export
+        current = set(shard['file'] for shard in manifest['shards'])
+        for fname in os.listdir(self.shard_dir):
+            if fname.endswith('.json') and fname != 'manifest.json' and \
+                    fname not in current:
+                os.remove(self.shard_dir + '/' + fname)
+
+        spool.close()
+
+        with open(self.shard_dir + '/manifest.json', 'w') as f:
+            json.dump(manifest, f, indent=1)
+
+
+class NormalizedSink:
+    #--------------------------------------------------------------------------
+    # normalized sqlite3 output, <schedule>_<STATUS>_norm.sql3: one row per
+    # drug plus indexed child tables keyed by drug_code, and a full text
+    # index over brand names and ingredients (when sqlite has FTS5)
+    tables = {
+        'drug': ['drug_code', 'id', 'status', 'status_f', 'company_code',
+            'ph_std', 'packaging', 'packaging_f', 'upc', 'category', 'class',
+            'class_f', 'brand_name', 'brand_name_f', 'descriptor',
+            'descriptor_f', 'last_update_date'],
+        'ingredient': ['drug_code', 'ingredient', 'ingredient_f', 'strength',
+            'strength_unit', 'strength_unit_f', 'active_ingredient_code',
+            'ingredient_key', 'dosage_value', 'dosage_unit', 'amount REAL',
+            'amount_unit'],
+        'dosage_form': ['drug_code', 'dosage_form', 'dosage_form_f'],
+        'route': ['drug_code', 'route', 'route_f'],
+        'schedule': ['drug_code', 'schedule', 'schedule_f'],
+        'company': ['drug_code', 'company_code', 'company_name'],
+        'status_history': ['drug_code', 'status', 'status_f', 'history_date',
+            'current_status_flag', 'lot_number', 'expiration_date'],
+    }
+    indexes = {
+        'drug': ['drug_code', 'id', 'brand_name', 'company_code'],
+        'ingredient': ['drug_code', 'ingredient',
+            'active_ingredient_code, amount_unit, amount',
+            'ingredient_key, amount_unit, amount'],
+        'dosage_form': ['drug_code', 'dosage_form'],
+        'route': ['drug_code', 'route'],
+        'schedule': ['drug_code', 'schedule'],
+        'company': ['drug_code', 'company_code'],
+        'status_history': ['drug_code, history_date', 'history_date'],
+    }
+
+    def __init__(self, outfilename, drug_data):
+        self.dbname = outfilename + '_norm.sql3'
+
+        if os.path.isfile(self.dbname):
+            os.remove(self.dbname)
+
+        self.con = sqlite3.connect(self.dbname)
+        self.cursor = self.con.cursor()
+        for pragma in sqlite_load_pragmas:
+            self.cursor.execute('PRAGMA ' + pragma)
+
+        self.insert_sql = {}
+        self.rows = {}
+        for table, columns in self.tables.items():
+            self.cursor.execute('CREATE TABLE {} ({})'.format(table,
+                ', '.join(column if ' ' in column else column + ' TEXT'
+                    for column in columns)))
+            self.insert_sql[table] = 'INSERT INTO {} VALUES ({})'.format(
+                    table, ','.join(['?'] * len(columns)))
+            self.rows[table] = []
+
+        try:
+            self.cursor.execute("CREATE VIRTUAL TABLE drug_search USING fts5("
+                "drug_code UNINDEXED, brand_name, brand_name_f, ingredients,"
+                "ingredients_f, tokenize='unicode61 remove_diacritics 2',"
+                "prefix='2 3')")
+            self.insert_sql['drug_search'] = \
+                    'INSERT INTO drug_search VALUES (?,?,?,?,?)'
+            self.rows['drug_search'] = []
+        except sqlite3.OperationalError:
+            print('\tWARNING: sqlite3 has no FTS5, skipping drug_search')
+
+    @staticmethod
+    def outputs(outfilename):
+        return [outfilename + '_norm.sql3']
+
+    def append(self, table, row):
+        self.rows[table].append(row)
+        if len(self.rows[table]) >= sqlite_batch_size:
+            self.cursor.executemany(self.insert_sql[table], self.rows[table])
+            self.rows[table] = []
+
+    def add(self, idx, drug, row):
+        code = drug['drug_code']
+        self.append('drug', (code, drug['drug_identification_number'],
+            drug['status'], drug['status_f'], drug['company_code'],
+            drug['pharmaceutical_std'], drug['packaging'],
+            drug['packaging_f'], drug['upc'], drug['product_categorization'],
+            drug['class'], drug['class_f'], drug['brand_name'],
+            drug['brand_name_f'], drug['descriptor'], drug['descriptor_f'],
+            drug['last_update_date']))
+
+        for ingred in drug['active_ingredients']:
+            amount, amount_unit = normalize_strength(ingred['strength'],
+                    ingred['strength_unit'], ingred['dosage_value'],
+                    ingred['dosage_unit'])
+            self.append('ingredient', (code, ingred['ingredient'],
+                ingred['ingredient_f'], ingred['strength'],
+                ingred['strength_unit'], ingred['strength_unit_f'],
+                ingred['active_ingredient_code'],
+                ingredient_key(ingred['ingredient']), ingred['dosage_value'],
+                ingred['dosage_unit'], amount, amount_unit))
+        for form, form_f in zip(drug['dosage_form'], drug['dosage_form_f']):
+            self.append('dosage_form', (code, form, form_f))
+        for route, route_f in zip(drug['admin_route'], drug['admin_route_f']):
+            self.append('route', (code, route, route_f))
+        for schedule, schedule_f in zip(drug['schedule'], drug['schedule_f']):
+            self.append('schedule', (code, schedule, schedule_f))
+        self.append('company', (code, drug['company_code'],
+            drug['company_name']))
+        for entry in drug['status_history']:
+            self.append('status_history', (code, entry['status'],
+                entry['status_f'], entry['history_date'],
+                entry['current_status_flag'], entry['lot_number'],
+                entry['expiration_date']))
+
+        if 'drug_search' in self.rows:
+            self.append('drug_search', (code, drug['brand_name'],
+                drug['brand_name_f'], ' '.join(drug['ingredients']),
+                ' '.join(drug['ingredients_f'])))
+
+    def close(self):
+        for table in self.rows:
+            if self.rows[table]:
+                self.cursor.executemany(self.insert_sql[table],
+                        self.rows[table])
+        self.con.commit()
+
+        for table, columns in self.indexes.items():
+            for column in columns:
+                self.cursor.execute('CREATE INDEX {0}_{1} ON {0} ({2})'.format(
+                    table, column.replace(', ', '_'), column))
+        if 'drug_search' in self.rows:
+            self.cursor.execute(
+                    "INSERT INTO drug_search(drug_search) VALUES ('optimize')")
+        self.con.commit()
+        self.con.close()
+
+
+def ingredient_key(name):
+    # ingredient name as an index key: accents removed, upper case, single
+    # spaces, so that the english and french spellings of a name line up
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    return ' '.join(name.upper().split())
+
+
+def parse_number(value):
+    try:
+        return float(value.replace(',', ''))
+    except (AttributeError, ValueError):
+        return None
+
+
+def normalize_strength(strength, unit, dosage_value='', dosage_unit=''):
+    #--------------------------------------------------------------------------
+    # strength of an active ingredient in canonical units, (value, unit):
+    # masses in MG, volumes in ML, international units in IU; per ML or per G
+    # when the dosage is a volume or a mass (250 MG / 5 ML -> 50 MG/ML),
+    # otherwise per dosage form (200 MG per tablet -> 200 MG). Percentages
+    # and units that are already a ratio (MG/ML, MG/G...) are kept as they
+    # are, they do not depend on the dosage
+    # (None, unit) when the strength is not a number
+    value = parse_number(strength)
+    unit = unit.strip().upper()
+    if value is None:
+        return None, unit
+    if unit not in strength_units:
+        return value, unit
+    unit, factor = strength_units[unit]
+    value *= factor
+
+    dosage = parse_number(dosage_value)
+    dosage_unit = dosage_unit.strip().upper()
+    if dosage_unit in dosage_units and dosage:
+        per_unit, factor = dosage_units[dosage_unit]
+        return value / (dosage * factor), unit + '/' + per_unit
+    return value, unit
+
+
+def parse_strength(text):
+    # '200MG', '0.2 G', '5MG/ML' in the canonical units of normalize_strength
+    match = re.match(r'\s*([0-9.,]+)\s*([^/\s]+)\s*(?:/\s*([0-9.,]*)\s*(\S+))?',
+            text)
+    if match is None:
+        return None, None
+    value, unit, dosage, per_unit = match.groups()
+    return normalize_strength(value, unit, dosage or '1', per_unit or '')
+
+
+def drugs_with_ingredients(dbname, *criteria):
+    #--------------------------------------------------------------------------
+    # drugs containing all the given ingredients, from the ingredient table
+    # of a normalized output; each criterion is an ingredient name or
+    # active_ingredient_code, alone or as a tuple with a strength, or a low
+    # and a high strength for a range (either can be None):
+    #   drugs_with_ingredients(db, ('IBUPROFEN', '200MG'))
+    #   drugs_with_ingredients(db, 'CODEINE PHOSPHATE', ('ACETAMINOPHEN',
+    #           '300MG', '500MG'))
+    # each criterion is one seek of the (ingredient, amount) indexes and the
+    # drug codes are intersected
+    # returns [(drug_code, DIN, brand name)]
+    selects = []
+    params = []
+    for criterion in criteria:
+        if isinstance(criterion, (str, int)):
+            criterion = (criterion,)
+        ingredient, low, high = (tuple(criterion) + (None, None))[:3]
+        if len(criterion) == 2:
+            high = low
+
+        if isinstance(ingredient, int) or ingredient.isdigit():
+            sql = 'SELECT drug_code FROM ingredient WHERE active_ingredient_code = ?'
+            params.append(str(ingredient))
         else:
-            drug_id = drug_data[idx]['drug_identification_number']
-
-        if option == 'OTC':
-            if ('Human' not in drug_data[idx]['class']  or
-                    'CAT IV' in drug_data[idx]['product_categorization'] or
-                    'TEA (HERBAL)' in drug_data[idx]['dosage_form'] or
-                    'SHAMPOO' in drug_data[idx]['dosage_form'] or
-                    'SOAP' in drug_data[idx]['dosage_form'] or
-                    'STICK' in drug_data[idx]['dosage_form'] or
-                    'TOOTHPASTE' in drug_data[idx]['dosage_form'] or
-                    'WIPE' in drug_data[idx]['dosage_form'] or
-                    'OTC' not in drug_data[idx]['schedule']):
-                continue
-        elif option == 'PRS':
-            if ('Human' not in drug_data[idx]['class']  or
-                    'Prescription' not in drug_data[idx]['schedule']):
+            sql = 'SELECT drug_code FROM ingredient WHERE ingredient_key = ?'
+            params.append(ingredient_key(ingredient))
+
+        for bound, op, slack in ((low, '>=', 1 - 1e-9), (high, '<=', 1 + 1e-9)):
+            if bound is not None:
+                value, unit = parse_strength(bound)
+                if value is None:
+                    print('\tERROR: invalid strength {}'.format(bound))
+                    return None
+                sql += ' AND amount_unit = ? AND amount {} ?'.format(op)
+                params.extend([unit, value * slack])
+        selects.append(sql)
+
+    con = sqlite3.connect(dbname)
+    rows = con.execute('SELECT drug_code, id, brand_name FROM drug '
+            'WHERE drug_code IN ({}) ORDER BY brand_name'.format(
+                ' INTERSECT '.join(selects)), params).fetchall()
+    con.close()
+    return rows
+
+
+def status_snapshot(dbname, date, status=None):
+    #--------------------------------------------------------------------------
+    # status of every drug on a date (datetime.date or 'YYYY-MM-DD') from the
+    # status_history table of a normalized output: the latest history entry
+    # on or before the date, found by a seek on the (drug_code, history_date)
+    # index per drug; only the drugs with that status when one is given
+    # returns [(drug_code, DIN, brand name, status)]
+    if not isinstance(date, str):
+        date = date.isoformat()
+
+    con = sqlite3.connect(dbname)
+    rows = con.execute('''
+        SELECT * FROM (SELECT drug_code, id, brand_name,
+            (SELECT status FROM status_history h
+                WHERE h.drug_code = drug.drug_code AND h.history_date != ''
+                AND h.history_date <= ?
+                ORDER BY h.history_date DESC, h.rowid DESC LIMIT 1) AS status
+            FROM drug)
+        WHERE status IS NOT NULL AND (? IS NULL OR status = ?)
+        ''', (date, status, status)).fetchall()
+    con.close()
+    return rows
+
+
+class DictSqliteSink:
+    #--------------------------------------------------------------------------
+    # compact sqlite3 output, <schedule>_<STATUS>_dict.sql3: the repeated
+    # categorical columns of the drugs table are stored once in small
+    # lookup_<name> tables and referenced by integer key from the drug
+    # table; a drugs view gives back the columns of the flat output
+    def __init__(self, outfilename, drug_data):
+        self.dbname = outfilename + '_dict.sql3'
+
+        if os.path.isfile(self.dbname):
+            os.remove(self.dbname)
+
+        self.con = sqlite3.connect(self.dbname)
+        self.cursor = self.con.cursor()
+        for pragma in sqlite_load_pragmas:
+            self.cursor.execute('PRAGMA ' + pragma)
+
+        # drugs table column position -> (lookup name, value number)
+        self.encoded = {}
+        for name, columns in sqlite_dict_columns.items():
+            for n in range(len(columns)):
+                self.encoded[drugs_columns.index(columns[n])] = (name, n)
+        self.plain = [pos for pos in range(len(drugs_columns))
+                if pos not in self.encoded]
+        self.lookups = {name: {} for name in sqlite_dict_columns}
+
+        columns = ['{} TEXT'.format(drugs_columns[pos]) for pos in self.plain]
+        columns += ['{} INTEGER'.format(name) for name in sqlite_dict_columns]
+        self.cursor.execute('CREATE TABLE drug ({})'.format(', '.join(columns)))
+        self.insert_sql = 'INSERT INTO drug VALUES ({})'.format(
+                ','.join(['?'] * len(columns)))
+        self.rows = []
+
+    @staticmethod
+    def outputs(outfilename):
+        return [outfilename + '_dict.sql3']
+
+    def add(self, idx, drug, row):
+        values = [row[pos] for pos in self.plain]
+        for name, columns in sqlite_dict_columns.items():
+            value = tuple(row[drugs_columns.index(column)]
+                    for column in columns)
+            lookup = self.lookups[name]
+            if value not in lookup:
+                lookup[value] = len(lookup)
+            values.append(lookup[value])
+
+        self.rows.append(values)
+        if len(self.rows) >= sqlite_batch_size:
+            self.cursor.executemany(self.insert_sql, self.rows)
+            self.rows = []
+
+    def close(self):
+        if self.rows:
+            self.cursor.executemany(self.insert_sql, self.rows)
+            self.rows = []
+
+        for name, columns in sqlite_dict_columns.items():
+            self.cursor.execute(
+                'CREATE TABLE lookup_{} (key INTEGER PRIMARY KEY, {})'.format(
+                    name, ', '.join(column + ' TEXT' for column in columns)))
+            self.cursor.executemany('INSERT INTO lookup_{} VALUES ({})'.format(
+                name, ','.join(['?'] * (len(columns) + 1))),
+                ((key,) + value for value, key in self.lookups[name].items()))
+        self.con.commit()
+
+        for column in ['id', 'drug_code', 'brand_name', 'company']:
+            self.cursor.execute(
+                    'CREATE INDEX drug_{0} ON drug ({0})'.format(column))
+
+        # same columns, in the same order, as the drugs table of the flat
+        # sqlite3 output
+        select = []
+        for pos in range(len(drugs_columns)):
+            if pos in self.encoded:
+                name, n = self.encoded[pos]
+                select.append('lookup_{}.{}'.format(name, drugs_columns[pos]))
+            else:
+                select.append('drug.' + drugs_columns[pos])
+        joins = ['LEFT JOIN lookup_{0} ON lookup_{0}.key = drug.{0}'.format(
+            name) for name in sqlite_dict_columns]
+        self.cursor.execute('CREATE VIEW drugs AS SELECT {} FROM drug {}'.format(
+            ', '.join(select), ' '.join(joins)))
+        self.con.commit()
+        self.con.close()
+
+
+class DictJsonSink(FirebaseSink):
+    #--------------------------------------------------------------------------
+    # compact json variant of the firebase output, <schedule>_<STATUS>_dict.json:
+    #   {"drugs": {din: record}, "lookups": {name: [[value, ...], ...]}}
+    # where the categorical fields of a record are replaced by the index of
+    # their values in the lookup list (a list of indexes for list fields)
+    def __init__(self, outfilename, drug_data):
+        FirebaseSink.__init__(self, outfilename, drug_data)
+        self.fbname = outfilename + '_dict.json'
+        self.lookups = {name: {} for name in json_dict_fields}
+
+    @staticmethod
+    def outputs(outfilename):
+        return [json_file_name(outfilename + '_dict.json')]
+
+    def encode(self, value, name):
+        lookup = self.lookups[name]
+        if value not in lookup:
+            lookup[value] = len(lookup)
+        return lookup[value]
+
+    def compact_record(self, drug):
+        drug = firebase_record(drug)
+        for name, fields in json_dict_fields.items():
+            values = [drug.pop(field) for field in fields if field in drug]
+            if len(values) != len(fields):
                 continue
-        elif option == 'OTC+PRS':
-            if (('Human' not in drug_data[idx]['class'] or
-                    'CAT IV' in drug_data[idx]['product_categorization'] or
-                    'TEA (HERBAL)' in drug_data[idx]['dosage_form'] or
-                    'SHAMPOO' in drug_data[idx]['dosage_form'] or
-                    'SOAP' in drug_data[idx]['dosage_form'] or
-                    'STICK' in drug_data[idx]['dosage_form'] or
-                    'TOOTHPASTE' in drug_data[idx]['dosage_form'] or
-                    'WIPE' in drug_data[idx]['dosage_form'] or
-                    'OTC' not in drug_data[idx]['schedule']) and
-                    ('Human' not in drug_data[idx]['class'] or
-                    'Prescription' not in drug_data[idx]['schedule'])):
+            if isinstance(values[0], list):
+                drug[name] = [self.encode(value, name)
+                        for value in zip(*values)]
+            else:
+                drug[name] = self.encode(tuple(values), name)
+        return drug
+
+    def close(self):
+        with open_json_output(self.fbname) as f:
+            f.write('{"drugs": ')
+            write_json_dict(f, ((din, self.compact_record(self.drug_data[idx]))
+                for din, idx in self.fbkeys.items()))
+            f.write(', "lookups": ')
+            write_json_dict(f, ((name, list(self.lookups[name]))
+                for name in self.lookups))
+            f.write('}')
+
+
+def dedup_rank(policy, idx, drug):
+    # sort key of a duplicate record, the smallest one is kept
+    if policy == 'last_update':
+        return (-parse_dpd_date(drug['last_update_date']), idx)
+    elif policy == 'current_status':
+        status = drug.get('status')
+        if status in dedup_status_preference:
+            rank = dedup_status_preference.index(status)
+        else:
+            rank = len(dedup_status_preference)
+        return (rank, -parse_dpd_date(drug['last_update_date']), idx)
+    return (idx,)
+
+
+def parse_dpd_date(value):
+    # DPD dates (02-JUL-2021) as a sortable ordinal, 0 when missing
+    try:
+        return datetime.strptime(value, '%d-%b-%Y').toordinal()
+    except (TypeError, ValueError):
+        return 0
+
+
+def resolve_duplicate_dins(drug_data, policy=None, dins=None):
+    #--------------------------------------------------------------------------
+    # find every DIN listed more than once, wherever the records are, and
+    # keep one record per DIN according to the policy:
+    #   first          - the first record in the build data
+    #   last_update    - the latest last_update_date
+    #   current_status - the best current status (dedup_status_preference),
+    #                    then the latest last_update_date
+    # dins is the {DIN: record numbers} index when the caller already has it
+    # returns the record numbers to drop and a report of what was dropped
+    policy = policy or dedup_policy
+    if dins is None and isinstance(drug_data, BuildStore):
+        dins = drug_data.index_of('din')
+    elif dins is None:
+        dins = {}
+        for idx in range(len(drug_data)):
+            dins.setdefault(drug_data[idx]['drug_identification_number'],
+                    []).append(idx)
+
+    # in build order of the first record of each DIN
+    duplicates = sorted((idxs for idxs in dins.values() if len(idxs) > 1),
+            key=lambda idxs: idxs[0])
+
+    dropped = set()
+    report = []
+    for idxs in duplicates:
+        din = drug_data[idxs[0]]['drug_identification_number']
+        drugs = [drug_data[idx] for idx in idxs]
+        ranked = sorted(range(len(idxs)),
+                key=lambda n: dedup_rank(policy, idxs[n], drugs[n]))
+
+        entry = {'din': din, 'policy': policy, 'kept': None, 'dropped': []}
+        for n in ranked:
+            summary = {'index': idxs[n], 'drug_code': drugs[n]['drug_code'],
+                    'brand_name': drugs[n]['brand_name'],
+                    'status': drugs[n].get('status'),
+                    'last_update_date': drugs[n]['last_update_date']}
+            if entry['kept'] is None:
+                entry['kept'] = summary
+            else:
+                entry['dropped'].append(summary)
+                dropped.add(idxs[n])
+        report.append(entry)
+
+    return dropped, report
+
+
+def export_drug_data(drug_data, prod_status, options, policy=None):
+    #--------------------------------------------------------------------------
+    # classify every drug once and write it to the outputs of all the
+    # requested schedule options in a single pass
+
+    # DPD extract has duplicated entries with the same drug id, and not
+    # always next to each other: resolve them all before the export
+    dropped, report = resolve_duplicate_dins(drug_data, policy)
+    if report:
+        print('...{} duplicated DINs, {} records dropped'.format(len(report),
+            len(dropped)))
+
+    # outputs are written in a new release directory and published when
+    # they are complete, the duplicates report with them
+    release_dir = os.path.join(publish_dir, '{}-{}'.format(prod_status,
+        datetime.now().strftime('%Y%m%d-%H%M%S-%f')))
+    os.makedirs(release_dir)
+    with open(os.path.join(release_dir,
+            build_file_name(prod_status, '.duplicates.json')), 'w') as f:
+        json.dump(report, f, indent=1)
+
+    sinks = []
+    for option in options:
+        outfilename = os.path.join(release_dir,
+                output_name(prod_status, option))
+        for fmt in output_formats:
+            if not getattr(output_sinks[fmt], 'available', True):
+                print('\tERROR: pyarrow is needed for the {} output'.format(
+                    fmt))
                 continue
+            sinks.append((option, output_sinks[fmt](outfilename, drug_data)))
+
+    progress = Progress('...processing', len(drug_data))
+    for idx in range(len(drug_data)):
+        progress.update(idx)
+        if idx in dropped:
+            continue
+        drug = drug_data[idx]
+
+        otc, prs = classify_drug(drug)
+        row = None
+        for option, sink in sinks:
+            if option_selects(option, otc, prs):
+                if row is None:
+                    row = sqlite_row(drug)
+                sink.add(idx, drug, row)
+
+    progress.done()
+
+    for option, sink in sinks:
+        sink.close()
+
+    publish_release(release_dir)
+    prune_releases(prod_status)
+
+
+def publish_release(release_dir):
+    #--------------------------------------------------------------------------
+    # make the outputs of a release current: every output name is a symlink
+    # into its release directory, replaced atomically, so a reader opens
+    # either the previous complete file or the new one, and files already
+    # open keep reading the previous release
+    for name in sorted(os.listdir(release_dir)):
+        link = name + '.tmp'
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(os.path.join(release_dir, name), link)
+        # outputs of older versions are real files or directories; a
+        # directory cannot be replaced by a symlink, remove it first
+        if os.path.isdir(name) and not os.path.islink(name):
+            shutil.rmtree(name)
+        os.replace(link, name)
+
+
+def published_release(name):
+    # release directory an output symlink points to, None for other files
+    if not os.path.islink(name):
+        return None
+    release_dir = os.path.dirname(os.readlink(name))
+    if os.path.dirname(release_dir) != publish_dir:
+        return None
+    return os.path.basename(release_dir)
+
+
+def prune_releases(prod_status):
+    #--------------------------------------------------------------------------
+    # remove the release directories of a product status beyond the last
+    # publish_keep ones, except those an output still points to
+    prefix = prod_status + '-'
+    releases = sorted(name for name in os.listdir(publish_dir)
+            if name.startswith(prefix))
+    used = set()
+    for name in os.listdir('.'):
+        release = published_release(name)
+        if release is not None:
+            used.add(release)
+
+    for name in releases[:-publish_keep or None]:
+        if name not in used:
+            shutil.rmtree(os.path.join(publish_dir, name))
+
+
+def remove_outputs():
+    #--------------------------------------------------------------------------
+    # remove the build data, the outputs and their releases; the downloaded
+    # zip archives and the release history are input data, keep them
+    for name in os.listdir('.'):
+        if published_release(name) is not None:
+            os.remove(name)
+        elif name.endswith(output_exts) and not os.path.islink(name):
+            if os.path.isdir(name):
+                shutil.rmtree(name)
+            else:
+                os.remove(name)
+    if os.path.isdir(publish_dir):
+        shutil.rmtree(publish_dir)
+
+class ParquetSink:
+    #--------------------------------------------------------------------------
+    # columnar output of the merged build records, <schedule>_<STATUS>.parquet
+    # (needs pyarrow): one column per build field, list<string> columns for
+    # the multi valued fields (ingredients, dosage forms, routes, schedules,
+    # ...) and list<struct> columns for status_history and active_ingredients,
+    # written in row groups of parquet_row_group_size records
+    available = pa is not None
+    ext = '.parquet'
+    # fields merge_drugs adds to the drug_product fields, in that order;
+    # the list_fields are list<string> columns
+    merged_fields = ['ingredients', 'ingredients_f', 'company_name',
+            'company_code', 'dosage_form', 'dosage_form_f', 'admin_route',
+            'admin_route_f', 'schedule', 'schedule_f', 'status', 'status_f',
+            'tc_atc', 'tc_atc_f', 'tc_ahfs', 'tc_ahfs_f', 'vet_species',
+            'vet_species_f', 'status_history', 'active_ingredients']
+    list_fields = ['ingredients', 'ingredients_f', 'dosage_form',
+            'dosage_form_f', 'admin_route', 'admin_route_f', 'schedule',
+            'schedule_f', 'vet_species', 'vet_species_f']
+    # fields of the list of dict columns
+    struct_fields = {
+        'status_history': ['status', 'status_f', 'history_date',
+            'current_status_flag', 'lot_number', 'expiration_date'],
+        'active_ingredients': ['ingredient', 'ingredient_f', 'strength',
+            'strength_unit', 'strength_unit_f', 'active_ingredient_code',
+            'dosage_value', 'dosage_unit'],
+    }
+
+    def __init__(self, outfilename, drug_data):
+        self.fname = outfilename + self.ext
+        if os.path.isfile(self.fname):
+            os.remove(self.fname)
+
+        self.schema = self.drug_schema()
+        self.writer = self.open_writer()
+        self.drugs = []
+
+    @classmethod
+    def outputs(cls, outfilename):
+        return [outfilename + cls.ext]
+
+    @classmethod
+    def drug_schema(cls):
+        #----------------------------------------------------------------------
+        # the same columns for every output, whatever the records hold:
+        # string columns for the drug_product fields and the single valued
+        # merged fields, lists of strings or of structs for the others
+        fields = []
+        for key in worksheet['drug_product']['names'] + cls.merged_fields:
+            if key in cls.struct_fields:
+                fields.append(pa.field(key, pa.list_(pa.struct(
+                    [(name, pa.string()) for name in cls.struct_fields[key]]))))
+            elif key in cls.list_fields:
+                fields.append(pa.field(key, pa.list_(pa.string())))
+            else:
+                fields.append(pa.field(key, pa.string()))
+        return pa.schema(fields)
+
+    def column_values(self, drug):
+        # record with every column of the schema: a missing single valued
+        # field (no company, status or class row) is null, a missing multi
+        # valued one an empty list
+        return {field.name: drug.get(field.name,
+            [] if pa.types.is_list(field.type) else None)
+            for field in self.schema}
+
+    def open_writer(self):
+        return pq.ParquetWriter(self.fname, self.schema,
+                compression=arrow_compression)
+
+    def add(self, idx, drug, row):
+        self.drugs.append(drug)
+        if len(self.drugs) >= parquet_row_group_size:
+            self.flush()
+
+    def flush(self):
+        self.writer.write_table(pa.Table.from_pylist(
+            [self.column_values(drug) for drug in self.drugs],
+            schema=self.schema))
+        self.drugs = []
+
+    def close(self):
+        if self.drugs:
+            self.flush()
+        self.writer.close()
+
+
+class ArrowSink(ParquetSink):
+    #--------------------------------------------------------------------------
+    # same columns as ParquetSink in an Arrow IPC file,
+    # <schedule>_<STATUS>.arrow, for memory mapped reads
+    ext = '.arrow'
+
+    def open_writer(self):
+        return pa.ipc.new_file(self.fname, self.schema,
+                options=pa.ipc.IpcWriteOptions(compression=arrow_compression))
+
+
+# output format name -> sink writing it
+output_sinks = {'sqlite': SqliteSink, 'json': FirebaseSink,
+        'shards': FirebaseShardSink, 'norm': NormalizedSink,
+        'dict': DictSqliteSink, 'dict_json': DictJsonSink,
+        'parquet': ParquetSink, 'arrow': ArrowSink}
+
+
+def unavailable_formats(formats):
+    # output formats whose optional dependency (pyarrow) is not installed
+    return [fmt for fmt in formats
+            if not getattr(output_sinks[fmt], 'available', True)]
+
+
+def create_sqlite_database(drug_data, prod_status, option=None):
+    export_drug_data(drug_data, prod_status, [option])
+
+
+def extract_fingerprints(prod_status):
+    #--------------------------------------------------------------------------
+    # content hash of every source file of a product status
+    suffix = suffixes[prod_status]
+    sources = extract_sources(prod_status)
+    fingerprints = {}
+    for f in source_files:
+        fname = extract_file_name(f.split('.')[0], suffix)
+        if fname in sources:
+            digest = hashlib.sha256()
+            with open_extract(sources[fname]) as fp:
+                for chunk in iter(lambda: fp.read(1 << 20), b''):
+                    digest.update(chunk)
+            fingerprints[fname] = digest.hexdigest()
+    return fingerprints
+
+
+def load_manifest(prod_status):
+    # build manifest of a product status: source file hashes, build id and
+    # the build id each output was exported from
+    try:
+        with open(build_file_name(prod_status, '.manifest.json')) as f:
+            return json.load(f)
+    except:
+        return {}
+
+
+def save_manifest(prod_status, manifest):
+    fname = build_file_name(prod_status, '.manifest.json')
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(fname + '.tmp', fname)
+
+
+def build_id(fingerprints):
+    # the build is determined by the source files and the build format
+    digest = hashlib.sha256(str(build_format_version).encode())
+    for fname in sorted(fingerprints):
+        digest.update('{}:{}\n'.format(fname, fingerprints[fname]).encode())
+    return digest.hexdigest()
+
+
+def peak_rss_mb(children=False):
+    # high-water mark of the resident set of this process, or of its largest
+    # terminated worker process, in MB
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children
+            else resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return round(peak / (1024 * 1024), 1)
+    return round(peak / 1024, 1)
+
+
+def stage_peak(before, after):
+    # the high-water mark is kept for the lifetime of the process, so a stage
+    # only has a peak of its own when it raised it
+    if after is None or after <= before:
+        return None
+    return after
 
-        cursor.execute("INSERT INTO drugs VALUES ("
-            "'{}','{}','{}','{}',"
-            "'{}','{}','{}','{}',"
-            "'{}','{}','{}','{}',"
-            "'{}','{}','{}','{}',"
-            "'{}','{}','{}','{}',"
-            "'{}','{}','{}','{}','{}')".format(
-            drug_data[idx]['drug_identification_number'],
-            drug_data[idx]['drug_code'],
-            drug_data[idx]['status'],
-            drug_data[idx]['status_f'].replace("'",r"''"),
-            #
-            drug_data[idx]['company_name'].replace("'",r"''"),
-            drug_data[idx]['company_code'],
-            drug_data[idx]['pharmaceutical_std'],
-            drug_data[idx]['packaging'].replace("'",r"''"),
-            #
-            drug_data[idx]['packaging_f'].replace("'",r"''"),
-            drug_data[idx]['upc'],
-            drug_data[idx]['product_categorization'].replace("'",r"''"),
-            drug_data[idx]['class'].replace("'",r"''"),
-            #
-            drug_data[idx]['class_f'].replace("'",r"''"),
-            drug_data[idx]['brand_name'].replace("'",r"''"),
-            drug_data[idx]['brand_name_f'].replace("'",r"''"),
-            ','.join(drug_data[idx]['ingredients']).replace("'",r"''"),
-            #
-            ','.join(drug_data[idx]['ingredients_f']).replace("'",r"''"),
-            ','.join(drug_data[idx]['dosage_form']).replace("'",r"''"),
-            ','.join(drug_data[idx]['dosage_form_f']).replace("'",r"''"),
-            ','.join(drug_data[idx]['admin_route']).replace("'",r"''"),
-            #
-            ','.join(drug_data[idx]['admin_route_f']).replace("'",r"''"),
-            ','.join(drug_data[idx]['schedule']).replace("'",r"''"),
-            ','.join(drug_data[idx]['schedule_f']).replace("'",r"''"),
-            drug_data[idx]['descriptor'].replace("'",r"''"),
-            #
-            drug_data[idx]['descriptor_f'].replace("'",r"''")))
-
-        # add the item to firebase dict with id as a key
-        fbdict[drug_data[idx]['drug_identification_number']] = drug_data[idx]
 
+class Progress:
+    #--------------------------------------------------------------------------
+    # progress line, printed at most once every progress_interval seconds
+    def __init__(self, label, total, enabled=True):
+        self.label = label
+        self.total = total
+        self.enabled = enabled
+        self.last = time.monotonic()
+
+    def update(self, count):
+        if self.enabled:
+            now = time.monotonic()
+            if now - self.last >= progress_interval:
+                self.last = now
+                print('{} {}/{}'.format(self.label, count, self.total),
+                        end='\r', flush=True)
+
+    def done(self):
+        if self.enabled:
+            print('{} {}/{}'.format(self.label, self.total, self.total))
+
+
+@contextmanager
+def run_stage(name, prod_status):
+    #--------------------------------------------------------------------------
+    # time a stage of the run; the caller sets stage['rows'] and the record
+    # is added to run_stages once the stage is over
+    stage = {'stage': name, 'status': prod_status, 'rows': 0}
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    peak = peak_rss_mb()
+    worker_peak = peak_rss_mb(children=True)
+    yield stage
+    wall = time.perf_counter() - wall
+    stage['wall_s'] = round(wall, 3)
+    stage['cpu_s'] = round(time.process_time() - cpu, 3)
+    stage['rows_per_s'] = round(stage['rows'] / wall) if wall > 0 else None
+    stage['peak_rss_mb'] = stage_peak(peak, peak_rss_mb())
+    stage['worker_peak_rss_mb'] = stage_peak(worker_peak,
+            peak_rss_mb(children=True))
+    run_stages.append(stage)
+
+
+def write_run_report(prod_statuses, schedules, started, fname=None):
+    #--------------------------------------------------------------------------
+    # machine readable report of the last run: stage timings, totals per
+    # status and the size of every output, next to the outputs
+    totals = {}
+    for stage in run_stages:
+        total = totals.setdefault(stage['status'], {'wall_s': 0, 'cpu_s': 0,
+            'drugs': None, 'peak_rss_mb': None, 'worker_peak_rss_mb': None})
+        total['wall_s'] = round(total['wall_s'] + stage['wall_s'], 3)
+        total['cpu_s'] = round(total['cpu_s'] + stage['cpu_s'], 3)
+        if stage['stage'] in ('build', 'export'):
+            total['drugs'] = stage['rows']
+        for field in ('peak_rss_mb', 'worker_peak_rss_mb'):
+            if stage[field] is not None:
+                total[field] = max(total[field] or 0, stage[field])
+
+    outputs = []
+    for prod_status in prod_statuses:
+        for option in schedules:
+            for fmt in output_formats:
+                for name in output_sinks[fmt].outputs(
+                        output_name(prod_status, option)):
+                    if os.path.isfile(name):
+                        outputs.append({'file': name,
+                            'bytes': os.path.getsize(name)})
+
+    report = {'started': started.isoformat(timespec='seconds'),
+            'finished': datetime.now().isoformat(timespec='seconds'),
+            'statuses': prod_statuses, 'schedules': schedules,
+            'formats': output_formats, 'jobs': build_jobs,
+            'stages': run_stages, 'totals': totals, 'outputs': outputs}
+    with open(fname or run_report_name, 'w') as f:
+        json.dump(report, f, indent=1)
+    return report
+
+
+def history_file_name(prod_status):
+    return '{}_{}.db'.format(history_prefix, prod_status)
+
+
+def open_history(prod_status):
+    #--------------------------------------------------------------------------
+    # release history of a product status, history_<STATUS>.db: every build
+    # is a release listing the record hash of each DIN, and the records are
+    # stored once by content hash, so unchanged drugs cost one index row
+    con = sqlite3.connect(history_file_name(prod_status))
+    con.executescript('''
+        CREATE TABLE IF NOT EXISTS release (release_id INTEGER PRIMARY KEY,
+            build TEXT, created TEXT, drugs INTEGER);
+        CREATE TABLE IF NOT EXISTS record (hash TEXT PRIMARY KEY, data TEXT)
+            WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS release_record (release_id INTEGER,
+            din TEXT, hash TEXT, PRIMARY KEY (release_id, din)) WITHOUT ROWID;
+        ''')
+    return con
+
+
+def record_hash(drug):
+    # canonical json of a build record and its content hash
+    data = json.dumps(drug, sort_keys=True, ensure_ascii=False,
+            separators=(',', ':'))
+    return hashlib.blake2b(data.encode('utf-8'), digest_size=16).hexdigest(), data
+
+
+def record_release(drug_data, prod_status, build):
+    #--------------------------------------------------------------------------
+    # add the build data as a new release unless it is the latest one already
+    # returns the release id
+    con = open_history(prod_status)
+    latest = con.execute('SELECT release_id, build FROM release '
+            'ORDER BY release_id DESC LIMIT 1').fetchone()
+    if latest is not None and latest[1] == build:
+        con.close()
+        return latest[0]
+
+    # one record per DIN, the one kept in the outputs
+    dropped, report = resolve_duplicate_dins(drug_data)
+
+    cursor = con.cursor()
+    cursor.execute('INSERT INTO release (build, created, drugs) '
+            'VALUES (?,?,?)', (build, datetime.now().isoformat(
+                timespec='seconds'), len(drug_data) - len(dropped)))
+    release_id = cursor.lastrowid
+
+    records = []
+    entries = []
+    for idx in range(len(drug_data)):
+        if idx in dropped:
+            continue
+        drug = drug_data[idx]
+        digest, data = record_hash(drug)
+        records.append((digest, data))
+        entries.append((release_id, drug['drug_identification_number'],
+            digest))
+        if len(entries) >= sqlite_batch_size:
+            cursor.executemany('INSERT OR IGNORE INTO record VALUES (?,?)',
+                    records)
+            cursor.executemany('INSERT INTO release_record VALUES (?,?,?)',
+                    entries)
+            records = []
+            entries = []
+    cursor.executemany('INSERT OR IGNORE INTO record VALUES (?,?)', records)
+    cursor.executemany('INSERT INTO release_record VALUES (?,?,?)', entries)
     con.commit()
     con.close()
+    return release_id
 
-    '''
-    # create archive from the sql3 file
-    shutil.make_archive(outfilename, 'zip', '.', dbname)
-    '''
 
-    # create json file for firebase storage
-    with open(fbname, 'w') as f:
-        json.dump(fbdict, f)
+def list_releases(prod_status):
+    # [(release id, build id, created, number of drugs)] oldest first
+    con = open_history(prod_status)
+    releases = con.execute('SELECT release_id, build, created, drugs '
+            'FROM release ORDER BY release_id').fetchall()
+    con.close()
+    return releases
+
 
+def release_changes(prod_status, since, until=None, records=False):
+    #--------------------------------------------------------------------------
+    # DINs added, removed and modified from release `since` to release
+    # `until` (the latest by default), answered from the release index
+    # without reading the records; with records=True the added and modified
+    # entries map each DIN to its new build record
+    con = open_history(prod_status)
+    if until is None:
+        until = con.execute('SELECT max(release_id) FROM release').fetchone()[0]
+
+    added = con.execute('SELECT n.din, n.hash FROM release_record n '
+            'LEFT JOIN release_record o ON o.release_id = ? AND o.din = n.din '
+            'WHERE n.release_id = ? AND o.din IS NULL ORDER BY n.din',
+            (since, until)).fetchall()
+    removed = con.execute('SELECT o.din FROM release_record o '
+            'LEFT JOIN release_record n ON n.release_id = ? AND n.din = o.din '
+            'WHERE o.release_id = ? AND n.din IS NULL ORDER BY o.din',
+            (until, since)).fetchall()
+    modified = con.execute('SELECT n.din, n.hash FROM release_record n '
+            'JOIN release_record o ON o.release_id = ? AND o.din = n.din '
+            'WHERE n.release_id = ? AND o.hash != n.hash ORDER BY n.din',
+            (since, until)).fetchall()
+
+    changes = {'since': since, 'until': until,
+            'removed': [row[0] for row in removed]}
+    for name, rows in (('added', added), ('modified', modified)):
+        if records:
+            changes[name] = {}
+            for din, digest in rows:
+                data = con.execute('SELECT data FROM record WHERE hash = ?',
+                        (digest,)).fetchone()[0]
+                changes[name][din] = json.loads(data)
+        else:
+            changes[name] = [row[0] for row in rows]
+    con.close()
+    return changes
+
+
+def build_is_current(prod_status, manifest, fingerprints):
+    # whether the build data was made from these extract files
+    return (manifest.get('build') == build_id(fingerprints) and
+            os.path.isfile(build_file_name(prod_status)))
+
+
+def pending_exports(prod_status, schedules, manifest):
+    #--------------------------------------------------------------------------
+    # schedule options whose outputs are missing or not made from the build
+    # of the manifest; a change of the duplicate DIN policy also changes
+    # the outputs. returns the options and the export id to record
+    exports = manifest.get('exports', {})
+    export_id = '{}:{}'.format(manifest.get('build'), dedup_policy)
+    todo = []
+    for option in schedules:
+        outfilename = output_name(prod_status, option)
+        current = (manifest.get('build') is not None and
+                exports.get(option) == export_id)
+        for fmt in output_formats:
+            for fname in output_sinks[fmt].outputs(outfilename):
+                if not os.path.isfile(fname):
+                    current = False
+        if not current:
+            todo.append(option)
+    return todo, export_id
+
+
+def plan_status(prod_status, schedules, force=False):
+    # stages build_status would run for a product status, without running
+    # them; the extract fingerprints are returned for build_status to reuse
+    if force:
+        return {'status': prod_status, 'build': True, 'exports': schedules,
+                'fingerprints': None}
+    manifest = load_manifest(prod_status)
+    fingerprints = extract_fingerprints(prod_status)
+    if not build_is_current(prod_status, manifest, fingerprints):
+        return {'status': prod_status, 'build': True, 'exports': schedules,
+                'fingerprints': fingerprints}
+    todo, export_id = pending_exports(prod_status, schedules, manifest)
+    return {'status': prod_status, 'build': False, 'exports': todo,
+            'fingerprints': fingerprints}
+
+
+def build_status(prod_status, schedules, rebuild=True, jobs=1, force=False,
+        fingerprints=None):
+    #--------------------------------------------------------------------------
+    # load, build and export one product status; safe to run in a worker
+    # process since every process has its own worksheet. force rebuilds
+    # everything from the extracts even when they did not change.
+    # fingerprints are the extract hashes when the caller already has them
+    manifest = load_manifest(prod_status)
+    drug_data = None
+
+    if rebuild:
+        # skip the build when the extracts did not change since the last one
+        with run_stage('check', prod_status) as stage:
+            if fingerprints is None:
+                fingerprints = extract_fingerprints(prod_status)
+            stage['rows'] = len(fingerprints)
+        if not force and build_is_current(prod_status, manifest,
+                fingerprints):
+            print('  {} extracts unchanged... using build data'.format(
+                prod_status))
+            rebuild = False
+
+    if not rebuild:
+        drug_data = load_build_data(prod_status)
+        if drug_data is None:
+            print('  Failed to load build data... Rebuilding... ')
+            if fingerprints is None:
+                fingerprints = extract_fingerprints(prod_status)
+
+    if drug_data is None:
+        with run_stage('load', prod_status) as stage:
+            if not load_dpd_extracts(prod_status, jobs):
+                return False
+            for key in worksheet:
+                stage['rows'] += len(worksheet[key]['output'])
+        # a failed build leaves the manifest of the build on disk as it is
+        with run_stage('build', prod_status) as stage:
+            built = build_worksheet(prod_status, incremental=not force)
+            stage['rows'] = len(worksheet['drug_product']['output'])
+        if not built:
+            return False
+        manifest = {'files': fingerprints, 'build': build_id(fingerprints),
+                'exports': {}}
+        save_manifest(prod_status, manifest)
+        drug_data = load_build_data(prod_status)
+        if drug_data is None:
+            return False
+
+    # keep every new build in the release history
+    if keep_history and manifest.get('build') is not None:
+        with run_stage('history', prod_status) as stage:
+            record_release(drug_data, prod_status, manifest['build'])
+            stage['rows'] = len(drug_data)
+
+    # only export the outputs not already made from this build
+    exports = manifest.setdefault('exports', {})
+    todo, export_id = pending_exports(prod_status, schedules, manifest)
+
+    # an output that cannot be written would never be up to date: fail
+    # rather than publish the others without it on every run
+    missing = unavailable_formats(output_formats)
+    if todo and missing:
+        print('\tERROR: pyarrow is needed for the {} output'.format(
+            ', '.join(missing)))
+        drug_data.close()
+        return False
+
+    if todo:
+        with run_stage('export', prod_status) as stage:
+            export_drug_data(drug_data, prod_status, todo)
+            stage['rows'] = len(drug_data)
+        if manifest.get('build') is not None:
+            for option in todo:
+                exports[option] = export_id
+            save_manifest(prod_status, manifest)
+    else:
+        print('  {} outputs are up to date'.format(prod_status))
+    drug_data.close()
+    return True
+
+
+def build_status_worker(prod_status, schedules, rebuild, jobs, force,
+        formats, fingerprints=None):
+    # build_status in a worker process, returning the stages it timed
+    global output_formats
+    output_formats = formats
+    del run_stages[:]
+    return build_status(prod_status, schedules, rebuild, jobs, force,
+            fingerprints), run_stages
+
+
+def build_parallel(prod_statuses, schedules, rebuild, jobs, force=None,
+        fingerprints=None):
+    #--------------------------------------------------------------------------
+    # run each product status in its own worker process and split the rest
+    # of the cores among them for parsing the extract tables; rebuild, force
+    # and fingerprints are per product status, as in build_status
+    status_jobs = min(jobs, len(prod_statuses))
+    load_jobs = max(1, jobs // status_jobs)
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=status_jobs) as executor:
+        futures = {}
+        for prod_status in prod_statuses:
+            futures[prod_status] = executor.submit(build_status_worker,
+                    prod_status, schedules, rebuild[prod_status], load_jobs,
+                    (force or {}).get(prod_status, False), output_formats,
+                    (fingerprints or {}).get(prod_status))
+        for prod_status in prod_statuses:
+            try:
+                results[prod_status], stages = futures[prod_status].result()
+            except Exception as e:
+                print('\tERROR: {}: {}'.format(prod_status, e))
+                results[prod_status], stages = False, []
+            run_stages.extend(stages)
+            if not results[prod_status]:
+                print('\tERROR: failed to build {}'.format(prod_status))
+    return results
 
 
 def pprint(data_list, start, end, filter=None):
@@ -485,6 +2550,7 @@ def show_menu():
 * Build Data: {}
 * Selected Drug Product Status: {}
 * Selected Drug Schedule Type: {}
+* Build Jobs: {}
 
 Select Drug Product Status:
   (1) Marketed drugs
@@ -498,13 +2564,17 @@ Select Drug Schedule Type:
   (b) OTC drugs only
   (c) Prescription drugs only
   (d) All drug types
+  (e) Each of the above in one pass
 
 Select:
+  (j) Set Number of Build Jobs
   (r) Generate Output File
+  (v) Save Build Data as JSON
   (x) Clear Worksheet
   (q) Quit
 
-> '''.format(dpd_dataset, build_dataset, drug_prod_status, drug_schedule))
+> '''.format(dpd_dataset, build_dataset, drug_prod_status, drug_schedule,
+    build_jobs))
 
 
 def check_dpd_files():
@@ -512,28 +2582,22 @@ def check_dpd_files():
     dpd_dataset.clear()
 
     for k,v in suffixes.items():
-        if v == '':
-            dir_name = extract_dir
-        else:
-            dir_name = extract_dir + '_' + v
+        sources = extract_sources(k)
 
-        if os.path.isdir(dir_name):
+        if sources:
             flag = True
-            print('checking ' + dir_name)
+            print('checking ' + k)
 
             for f in source_files:
-                if v == '':
-                    file_name = f
-                else:
-                    file_name = f.split('.')[0] + '_' + v + '.' + f.split('.')[1]
+                file_name = extract_file_name(f.split('.')[0], v)
 
-                if not os.path.isfile(dir_name + '/' + file_name):
-                    print('>>>ERROR: {} not found in the {}'.format(
-                        file_name, dir_name))
+                if file_name not in sources:
+                    print('>>>ERROR: {} not found for {}'.format(
+                        file_name, k))
                     flag = False
                     break
             if flag:
-                print('  ..{} looks o.k.'.format(dir_name))
+                print('  ..{} looks o.k.'.format(k))
                 dpd_dataset.append(k)
 
     #print(dpd_dataset)
@@ -545,16 +2609,268 @@ def check_build_files():
 
     for f in os.listdir():
         if (f.startswith(build_prefix) and
-                f.endswith('.json') and
+                f.endswith((build_ext, '.json')) and
                 len(f.split('_')) > 1 and
                 f.split('_')[1].split('.')[0] in suffixes):
-            build_dataset.append(f.split('_')[1].split('.')[0])
+            if f.split('_')[1].split('.')[0] not in build_dataset:
+                build_dataset.append(f.split('_')[1].split('.')[0])
 
     print(build_dataset)
 
 #-------------------------------------------------------------------------------
+def extracts_complete(prod_status):
+    # whether every extract file of a product status is there
+    sources = extract_sources(prod_status)
+    for f in source_files:
+        if extract_file_name(f.split('.')[0], suffixes[prod_status]) \
+                not in sources:
+            return False
+    return True
+
+
+def extract_signature(prod_status):
+    # size and modification time of the extract files (or their archives),
+    # cheap enough to check every few seconds
+    signature = []
+    for name, (archive, path) in sorted(extract_sources(prod_status).items()):
+        try:
+            st = os.stat(archive or path)
+        except OSError:
+            continue
+        signature.append((name, st.st_size, st.st_mtime_ns))
+    return signature
+
+
+def notify_subscribers(subscribers, event):
+    # send an event as a json line to every subscriber, dropping the ones
+    # that went away or do not keep up
+    line = (json.dumps(event) + '\n').encode('utf-8')
+    for conn in list(subscribers):
+        try:
+            conn.sendall(line)
+        except OSError:
+            subscribers.remove(conn)
+            conn.close()
+
+
+def watch(prod_statuses, schedules, jobs):
+    #--------------------------------------------------------------------------
+    # long running mode: check the extract files of the product statuses
+    # every watch_interval seconds, and once the files of a status stopped
+    # changing for watch_debounce seconds, build it in a worker process.
+    # The outputs are published as usual, then an event is sent to the
+    # subscribers of the watch_socket unix socket:
+    #   {"event": "published", "status": "MARKETED", "build": ..., ...}
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if os.path.exists(watch_socket):
+        os.remove(watch_socket)
+    server.bind(watch_socket)
+    server.listen()
+    subscribers = []
+
+    # at start, only the statuses whose build or outputs are not current
+    # with the extracts are built, as in batch mode; the fingerprints of
+    # the check are passed on to that first build
+    signatures = {}
+    changed = {}
+    fingerprints = {}
+    for prod_status in prod_statuses:
+        signatures[prod_status] = extract_signature(prod_status)
+        if not extracts_complete(prod_status):
+            changed[prod_status] = 0
+            continue
+        step = plan_status(prod_status, schedules)
+        if step['build'] or step['exports']:
+            changed[prod_status] = 0
+            fingerprints[prod_status] = step['fingerprints']
+        else:
+            print('  {} is up to date'.format(prod_status))
+    running = {}
+    print('watching {} (socket {})'.format(', '.join(prod_statuses),
+        watch_socket))
+
+    # stop on SIGTERM as on ctrl-c, removing the socket
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+
+    # the workers keep the default SIGTERM, a service manager stopping the
+    # whole process group ends them quietly
+    executor = ProcessPoolExecutor(max_workers=min(jobs, len(prod_statuses)),
+            initializer=signal.signal, initargs=(signal.SIGTERM,
+                signal.SIG_DFL))
+    load_jobs = max(1, jobs // len(prod_statuses))
+    try:
+        while True:
+            readable = select.select([server], [], [], watch_interval)[0]
+            if readable:
+                conn = server.accept()[0]
+                conn.settimeout(1)
+                subscribers.append(conn)
+
+            now = time.time()
+            for prod_status in prod_statuses:
+                signature = extract_signature(prod_status)
+                if signature != signatures[prod_status]:
+                    print('  {} extracts changed'.format(prod_status))
+                    signatures[prod_status] = signature
+                    changed[prod_status] = now
+                    fingerprints.pop(prod_status, None)
+
+                if (prod_status in changed and prod_status not in running and
+                        now - changed[prod_status] >= watch_debounce and
+                        extracts_complete(prod_status)):
+                    del changed[prod_status]
+                    running[prod_status] = (load_manifest(prod_status).get(
+                        'build'), executor.submit(build_status_worker,
+                            prod_status, schedules, True, load_jobs, False,
+                            output_formats, fingerprints.pop(prod_status,
+                                None)))
+
+            for prod_status, (previous, future) in list(running.items()):
+                if not future.done():
+                    continue
+                del running[prod_status]
+                try:
+                    ok = future.result()[0]
+                except Exception as e:
+                    print('\tERROR: {}: {}'.format(prod_status, e))
+                    ok = False
+                build = load_manifest(prod_status).get('build')
+                if not ok:
+                    event = 'failed'
+                elif build != previous:
+                    event = 'published'
+                else:
+                    continue
+                print('  {} {}'.format(prod_status, event))
+                notify_subscribers(subscribers, {'event': event,
+                    'status': prod_status, 'build': build,
+                    'outputs': [fname for option in schedules
+                        for fmt in output_formats
+                        for fname in output_sinks[fmt].outputs(
+                            output_name(prod_status, option))],
+                    'time': datetime.now().isoformat(timespec='seconds')})
+    except KeyboardInterrupt:
+        print('Bye')
+    finally:
+        executor.shutdown(cancel_futures=True)
+        for conn in subscribers:
+            conn.close()
+        server.close()
+        os.remove(watch_socket)
+    return 0
+
+
+def watch_events(path=None):
+    #--------------------------------------------------------------------------
+    # events of a running watch, for a service to reload the outputs of a
+    # product status when they are published:
+    #   for event in convert_data.watch_events():
+    #       if event['event'] == 'published': ...
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path or watch_socket)
+    with sock, sock.makefile('r', encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def run_batch(argv):
+    #--------------------------------------------------------------------------
+    # non-interactive entry point: build every product status x schedule
+    # option of the matrix and exit with 0 when all of them succeeded,
+    # 1 when any failed (2 for invalid arguments, from argparse); with
+    # --watch, keep building them as new extracts arrive
+    #   python3 convert_data.py --status MARKETED INACTIVE --schedule all
+    global output_formats, build_jobs
+
+    parser = argparse.ArgumentParser(description='build the DPD outputs of '
+            'every product status x schedule option; without arguments the '
+            'interactive menu is shown')
+    parser.add_argument('--status', nargs='+', default=['MARKETED'],
+            choices=list(suffixes) + ['all'], help='product statuses')
+    parser.add_argument('--schedule', nargs='+', default=['OTC'],
+            choices=list(output_prefixes) + ['all'],
+            help='schedule options')
+    parser.add_argument('--format', nargs='+', default=output_formats,
+            choices=list(output_sinks), help='output formats')
+    parser.add_argument('--jobs', type=int, default=build_jobs,
+            help='worker processes (default: number of cores)')
+    parser.add_argument('--force', action='store_true',
+            help='rebuild and export even when nothing changed')
+    parser.add_argument('--dry-run', action='store_true',
+            help='only print the stages that would run')
+    parser.add_argument('--report', default=run_report_name,
+            help='run report file')
+    parser.add_argument('--watch', action='store_true',
+            help='keep running and rebuild when the extract files change')
+    args = parser.parse_args(argv)
+
+    prod_statuses = list(suffixes) if 'all' in args.status else args.status
+    schedules = list(output_prefixes) if 'all' in args.schedule else \
+            args.schedule
+    output_formats = args.format
+    build_jobs = max(1, args.jobs)
+    missing = unavailable_formats(output_formats)
+    if missing:
+        parser.error('pyarrow is needed for the {} output'.format(
+            ', '.join(missing)))
+
+    # the extract files may not be there yet when watching
+    if args.watch:
+        return watch(prod_statuses, schedules, build_jobs)
+
+    # every file of a product status has to be there before anything runs
+    check_dpd_files()
+    missing = [s for s in prod_statuses if s not in dpd_dataset]
+    if missing:
+        print('\tERROR: extract files not found for {}'.format(
+            ', '.join(missing)))
+        return 1
+
+    plan = [plan_status(s, schedules, args.force) for s in prod_statuses]
+    for step in plan:
+        print('  {}: {}, export {}'.format(step['status'],
+            'build' if step['build'] else 'reuse build data',
+            ', '.join(step['exports']) or 'nothing'))
+    if args.dry_run:
+        return 0
+
+    # statuses with nothing to do are still checked by build_status, which
+    # is quick when the extracts and outputs are current; the extracts
+    # hashed for the plan are not hashed again
+    started = datetime.now()
+    rebuild = dict((s, True) for s in prod_statuses)
+    fingerprints = dict((step['status'], step['fingerprints'])
+            for step in plan)
+    if build_jobs > 1 and len(prod_statuses) > 1:
+        results = build_parallel(prod_statuses, schedules, rebuild,
+                build_jobs, dict((s, args.force) for s in prod_statuses),
+                fingerprints)
+    else:
+        results = {}
+        for prod_status in prod_statuses:
+            try:
+                results[prod_status] = build_status(prod_status, schedules,
+                        True, build_jobs, args.force,
+                        fingerprints[prod_status])
+            except Exception as e:
+                print('\tERROR: {}: {}'.format(prod_status, e))
+                results[prod_status] = False
+
+    write_run_report(prod_statuses, schedules, started, args.report)
+    failed = [s for s in prod_statuses if not results[s]]
+    if failed:
+        print('\tERROR: failed to build {}'.format(', '.join(failed)))
+        return 1
+    return 0
+
+
 if __name__ =='__main__':
 
+    if len(sys.argv) > 1:
+        sys.exit(run_batch(sys.argv[1:]))
+
     while(True):
         check_dpd_files()
         check_build_files()
@@ -598,39 +2914,67 @@ if __name__ =='__main__':
                 else:
                     input('  >>ERROR DPD Dataset is not found')
 
-        elif select in ('a','b','c','d'):
+        elif select in ('a','b','c','d','e'):
             if select == 'a':
-                drug_schedule = "OTC+PRS"
+                drug_schedule = ["OTC+PRS"]
             elif select == 'b':
-                drug_schedule = "OTC"
+                drug_schedule = ["OTC"]
             elif select == 'c':
-                drug_schedule = "PRS"
+                drug_schedule = ["PRS"]
             elif select == 'd':
-                drug_schedule = "ALL"
+                drug_schedule = ["ALL"]
+            elif select == 'e':
+                drug_schedule = ["OTC+PRS", "OTC", "PRS", "ALL"]
+
+        elif select == 'j':
+            res = input('  Number of build jobs (1-{}): '.format(
+                os.cpu_count() or 1))
+            if res.isdigit() and int(res) > 0:
+                build_jobs = int(res)
+            else:
+                input('  ERROR: invalid number of jobs')
 
         elif select == 'r':
 
+            started = datetime.now()
+            del run_stages[:]
+            rebuild = {}
+            force = {}
             for prod_status in drug_prod_status:
-                build_flag = True
+                rebuild[prod_status] = True
+                force[prod_status] = False
 
+                # declining the build data rebuilds it even when the
+                # extracts did not change
                 if prod_status in build_dataset:
                     res = input('  Build data for {} exists... '
                         'Do you want to use it? (y/N) '.format(prod_status))
                     if(res.upper() == 'Y'):
-                        build_flag = False
-
-                if build_flag == False:
-                    drug_data = load_build_data(prod_status)
-                    if drug_data == None:
-                        print('  Failed to load build data... Rebuilding... ')
-                        build_flag = True
-
-                if build_flag == True:
-                    load_dpd_extracts(prod_status)
-                    build_worksheet(prod_status)
-                    drug_data = load_build_data(prod_status)
-
-                create_sqlite_database(drug_data, prod_status, drug_schedule)
+                        rebuild[prod_status] = False
+                    else:
+                        force[prod_status] = True
+
+            if build_jobs > 1 and len(drug_prod_status) > 1:
+                results = build_parallel(drug_prod_status, drug_schedule,
+                        rebuild, build_jobs, force)
+            else:
+                results = {}
+                for prod_status in drug_prod_status:
+                    results[prod_status] = build_status(prod_status,
+                            drug_schedule, rebuild[prod_status], build_jobs,
+                            force[prod_status])
+
+            write_run_report(drug_prod_status, drug_schedule, started)
+            failed = [s for s in drug_prod_status if not results[s]]
+            if failed:
+                input('  ERROR: failed to build {}'.format(', '.join(failed)))
+
+        elif select == 'v':
+            for prod_status in drug_prod_status:
+                if os.path.isfile(build_file_name(prod_status)):
+                    build_store_to_json(prod_status)
+                else:
+                    input('  ERROR: No build data for {}'.format(prod_status))
 
         elif select == 'x':
-            os.system('rm *.json *.zip *.sql3')
+            remove_outputs()
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+#
+# Query the build data of convert_data.py in process: lookup by DIN or drug
+# code, brand name prefix search in english and french, and filters by
+# status, schedule and class
+#
+#   import dpd_query
+#   drugs = dpd_query.open_index('MARKETED')
+#   drugs.by_din('02511029')
+#   drugs.brand_prefix('advi', lang='en', limit=10)
+#   drugs.search('acet', status='MARKETED', schedule='OTC')
+#
+#   # reload on every build published by convert_data.py --watch
+#   for event in dpd_query.follow({'MARKETED': drugs}): ...
+#
+#   python3 dpd_query.py MARKETED --din 02511029
+#   python3 dpd_query.py MARKETED --prefix advi --schedule OTC
+#
+import argparse
+import json
+import unicodedata
+from bisect import bisect_left
+from collections import OrderedDict
+
+import convert_data
+
+
+def fold(text):
+    #--------------------------------------------------------------------------
+    # brand name as a search key: accents removed and case folded, so that
+    # 'eau' finds 'ÉAU' and the french names are searched the same way
+    text = unicodedata.normalize('NFKD', text)
+    return ''.join(c for c in text if not unicodedata.combining(c)).casefold()
+
+
+class DrugIndex:
+    #--------------------------------------------------------------------------
+    # indexes over a BuildStore; DIN and drug code lookups are dicts made
+    # from the key indexes of the build file when it is opened, the brand
+    # name and filter indexes are made in one pass over the records on first
+    # use. Records are decoded on demand and the last cache_size of them are
+    # kept in an LRU cache. A DIN listed more than once resolves to the
+    # record kept in the outputs (convert_data.dedup_policy)
+    def __init__(self, store, cache_size=4096, prod_status=None):
+        self.prod_status = prod_status
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.open(store)
+
+    def open(self, store):
+        # {DIN: record number} and {drug code: record number} of the
+        # records kept, the DIN index is the one duplicates are resolved on
+        self.store = store
+        dins = store.index_of('din')
+        self.dropped, report = convert_data.resolve_duplicate_dins(store,
+                dins=dins)
+        self.keys = {'din': self.kept(dins),
+                'drug_code': self.kept(store.index_of('drug_code'))}
+        self.brands = None
+        self.facets = None
+
+    def kept(self, index):
+        # first record of each key that is not a dropped duplicate
+        keys = {}
+        for key, idxs in index.items():
+            for idx in idxs:
+                if idx not in self.dropped:
+                    keys[key] = idx
+                    break
+        return keys
+
+    def reload(self):
+        #----------------------------------------------------------------------
+        # switch to the current build data of the product status, after a
+        # new build was published; the cache and the indexes of the previous
+        # build are dropped and made again on first use. False when the
+        # build data cannot be loaded, the previous build is kept then
+        store = convert_data.load_build_data(self.prod_status)
+        if store is None:
+            return False
+        self.store.close()
+        self.cache.clear()
+        self.open(store)
+        return True
+
+    def __len__(self):
+        return len(self.store) - len(self.dropped)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.store.close()
+
+    def record(self, idx):
+        # build record by record number, through the LRU cache
+        if idx in self.cache:
+            self.cache.move_to_end(idx)
+            return self.cache[idx]
+        drug = self.store[idx]
+        self.cache[idx] = drug
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return drug
+
+    def first(self, key, value):
+        # record number of a DIN or drug code, None when not found
+        return self.keys[key].get(value)
+
+    def by_din(self, din):
+        idx = self.first('din', din)
+        return None if idx is None else self.record(idx)
+
+    def by_drug_code(self, code):
+        idx = self.first('drug_code', str(code))
+        return None if idx is None else self.record(idx)
+
+    def make_indexes(self):
+        #----------------------------------------------------------------------
+        # sorted (folded brand name, record number) lists for each language,
+        # and record numbers by status, class and schedule option
+        brands = {'en': [], 'fr': []}
+        facets = {'status': {}, 'class': {}, 'schedule': {}}
+
+        for idx in range(len(self.store)):
+            if idx in self.dropped:
+                continue
+            drug = self.store[idx]
+            brands['en'].append((fold(drug['brand_name']), idx))
+            brands['fr'].append((fold(drug['brand_name_f']), idx))
+
+            facets['status'].setdefault(drug.get('status'), []).append(idx)
+            facets['class'].setdefault(drug['class'], []).append(idx)
+            otc, prs = convert_data.classify_drug(drug)
+            for option in convert_data.output_prefixes:
+                if convert_data.option_selects(option, otc, prs):
+                    facets['schedule'].setdefault(option, []).append(idx)
+
+        self.brands = {}
+        for lang in brands:
+            brands[lang].sort()
+            self.brands[lang] = ([key for key, idx in brands[lang]],
+                    [idx for key, idx in brands[lang]])
+        self.facets = {}
+        for name in facets:
+            self.facets[name] = dict((value, frozenset(idxs))
+                    for value, idxs in facets[name].items())
+
+    def prefix_matches(self, prefix, lang='en'):
+        # record numbers of the brand names starting with prefix, in name
+        # order, found by bisection of the sorted names
+        if self.brands is None:
+            self.make_indexes()
+        keys, idxs = self.brands[lang]
+        prefix = fold(prefix)
+        pos = bisect_left(keys, prefix)
+        while pos < len(keys) and keys[pos].startswith(prefix):
+            yield idxs[pos]
+            pos += 1
+
+    def brand_prefix(self, prefix, lang='en', limit=20):
+        return self.search(prefix, lang, limit=limit)
+
+    def matching(self, status=None, schedule=None, drug_class=None):
+        # record numbers passing the filters, None when there is no filter
+        if self.facets is None:
+            self.make_indexes()
+        selected = None
+        for name, value in (('status', status), ('schedule', schedule),
+                ('class', drug_class)):
+            if value is not None:
+                idxs = self.facets[name].get(value, frozenset())
+                selected = idxs if selected is None else selected & idxs
+        return selected
+
+    def filter(self, status=None, schedule=None, drug_class=None, limit=None):
+        #----------------------------------------------------------------------
+        # records with the given status (MARKETED, ...), schedule option
+        # (OTC, PRS, OTC+PRS, ALL) and class (Human, Veterinary, ...) in
+        # build order
+        selected = self.matching(status, schedule, drug_class)
+        if selected is None:
+            selected = (idx for idx in range(len(self.store))
+                    if idx not in self.dropped)
+        else:
+            selected = sorted(selected)
+        drugs = []
+        for idx in selected:
+            if limit is not None and len(drugs) >= limit:
+                break
+            drugs.append(self.record(idx))
+        return drugs
+
+    def search(self, prefix, lang='en', status=None, schedule=None,
+            drug_class=None, limit=20):
+        #----------------------------------------------------------------------
+        # records whose brand name starts with prefix, in name order,
+        # passing the filters of filter()
+        selected = self.matching(status, schedule, drug_class)
+        drugs = []
+        for idx in self.prefix_matches(prefix, lang):
+            if limit is not None and len(drugs) >= limit:
+                break
+            if selected is None or idx in selected:
+                drugs.append(self.record(idx))
+        return drugs
+
+
+def open_index(prod_status, cache_size=4096):
+    # DrugIndex over the build data of a product status, None on failure
+    store = convert_data.load_build_data(prod_status)
+    if store is None:
+        return None
+    return DrugIndex(store, cache_size, prod_status)
+
+
+def follow(indexes, path=None):
+    #--------------------------------------------------------------------------
+    # subscribe to the events of convert_data.py --watch and reload the
+    # DrugIndex of a product status ({status: index}) when a build of it is
+    # published; the events are passed on to the caller
+    for event in convert_data.watch_events(path):
+        drugs = indexes.get(event['status'])
+        if event['event'] == 'published' and drugs is not None:
+            drugs.reload()
+        yield event
+
+
+#-------------------------------------------------------------------------------
+if __name__ =='__main__':
+    parser = argparse.ArgumentParser(description='query the build data of '
+            'convert_data.py')
+    parser.add_argument('status', choices=list(convert_data.suffixes))
+    parser.add_argument('--din')
+    parser.add_argument('--drug-code')
+    parser.add_argument('--prefix', help='brand name prefix')
+    parser.add_argument('--lang', choices=['en', 'fr'], default='en')
+    parser.add_argument('--filter-status', help='current product status')
+    parser.add_argument('--schedule',
+            choices=list(convert_data.output_prefixes))
+    parser.add_argument('--class', dest='drug_class')
+    parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+
+    drugs = open_index(args.status)
+    if drugs is None:
+        raise SystemExit(1)
+
+    if args.din is not None:
+        results = [drugs.by_din(args.din)]
+    elif args.drug_code is not None:
+        results = [drugs.by_drug_code(args.drug_code)]
+    elif args.prefix is not None:
+        results = drugs.search(args.prefix, args.lang, args.filter_status,
+                args.schedule, args.drug_class, args.limit)
+    else:
+        results = drugs.filter(args.filter_status, args.schedule,
+                args.drug_class, args.limit)
+    drugs.close()
+
+    print(json.dumps([drug for drug in results if drug is not None],
+        indent=1, ensure_ascii=False))
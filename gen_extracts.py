@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+#
+# Generate synthetic DPD extract files, laid out like the Health Canada
+# extracts (allfiles*/ directories or allfiles*.zip + ther*.zip archives),
+# for benchmarking convert_data.py without the real data.
+#
+#   python3 gen_extracts.py -o bench_data --scale 10
+#
+import argparse
+import csv
+import os
+import random
+import shutil
+import tempfile
+import zipfile
+
+import convert_data
+
+# number of drugs of each product status at scale 1, about the size of the
+# real extracts
+base_drugs = {'MARKETED': 25000, 'APPROVED': 1500, 'INACTIVE': 30000,
+        'DORMANT': 800}
+
+# average number of rows per drug in each table, overridable from the
+# command line
+fan_out = {
+    'active_ingredients': 1.8,
+    'companies': 1,
+    'product_status': 2.5,
+    'dosage_form': 1.1,
+    'packaging': 1.3,
+    'pharmaceutical_standard': 0.6,
+    'route_of_administration': 1.2,
+    'schedule': 1.1,
+    'therapeutic_class': 1,
+    'veterinary_species': 0.05,
+}
+
+ingredients = ['ACETAMINOPHEN', 'IBUPROFEN', 'ACETYLSALICYLIC ACID',
+        'AMOXICILLIN', 'ATORVASTATIN', 'METFORMIN HYDROCHLORIDE',
+        'LEVOTHYROXINE SODIUM', 'SALBUTAMOL', 'ZINC OXIDE', 'MENTHOL',
+        'CAMPHOR', 'DEXTROMETHORPHAN HYDROBROMIDE', 'GUAIFENESIN',
+        'PSEUDOEPHEDRINE HYDROCHLORIDE', 'LORATADINE', 'CETIRIZINE',
+        'OMEPRAZOLE', 'RAMIPRIL', 'AMLODIPINE', 'PALIPERIDONE',
+        'TITANIUM DIOXIDE', 'OCTINOXATE', 'AVOBENZONE', 'ETHANOL',
+        'TRICLOSAN', 'BENZOYL PEROXIDE', 'HYDROCORTISONE', 'CLOTRIMAZOLE']
+ingredients_f = {'ACETAMINOPHEN': 'Acétaminophène',
+        'ACETYLSALICYLIC ACID': 'Acide acétylsalicylique',
+        'ZINC OXIDE': 'Oxyde de zinc', 'PALIPERIDONE': 'Palipéridone',
+        'TITANIUM DIOXIDE': 'Dioxyde de titane', 'ETHANOL': 'Éthanol'}
+units = [('MG', 'MG'), ('G', 'G'), ('MCG', 'MCG'), ('%', '%'),
+        ('IU', 'UI'), ('MG/ML', 'MG/ML'), ('ML', 'ML')]
+forms = [('TABLET', 'Comprimé'), ('CAPSULE', 'Capsule'),
+        ('TABLET (EXTENDED-RELEASE)', 'Comprimé (à libération prolongée)'),
+        ('CREAM', 'Crème'), ('LOTION', 'Lotion'), ('LIQUID', 'Liquide'),
+        ('SOLUTION', 'Solution'), ('SYRUP', 'Sirop'), ('SHAMPOO', 'Shampooing'),
+        ('SOAP', 'Savon'), ('STICK', 'Bâton'), ('TOOTHPASTE', 'Dentifrice'),
+        ('WIPE', 'Lingette'), ('TEA (HERBAL)', 'Tisane'),
+        ('POWDER', 'Poudre'), ('SPRAY', 'Vaporisateur')]
+routes = [('ORAL', 'Orale'), ('TOPICAL', 'Topique'),
+        ('INTRAVENOUS', 'Intraveineuse'), ('INHALATION', 'Inhalation'),
+        ('OPHTHALMIC', 'Ophtalmique'), ('NASAL', 'Nasale'),
+        ('INTRAMUSCULAR', 'Intramusculaire')]
+schedules = [('OTC', 'En vente libre'), ('Prescription', 'Prescription'),
+        ('Schedule G (CDSA III)', 'Annexe G (LRCDAS III)'),
+        ('Ethical', 'Éthique'), ('Narcotic (CDSA I)', 'Stupéfiant (LRCDAS I)')]
+statuses = [('MARKETED', 'Commercialisé'), ('APPROVED', 'Approuvé'),
+        ('CANCELLED POST MARKET', 'Annulé après commercialisation'),
+        ('DORMANT', 'Dormant'), ('CANCELLED PRE MARKET',
+            'Annulé avant commercialisation')]
+classes = [('Human', 'Humain'), ('Veterinary', 'Vétérinaire'),
+        ('Disinfectant', 'Désinfectant'), ('Radiopharmaceutical',
+            'Radiopharmaceutique')]
+categories = ['', '', '', 'CAT IV - SUNBURN PROTECTANTS',
+        'CAT IV - ANTIDANDRUFF PRODUCTS', 'CAT IV - MEDICATED SKIN CARE']
+pharm_stds = ['USP', 'BP', 'MFR', 'PH.EUR.']
+species = [('DOGS', 'Chiens'), ('CATS', 'Chats'), ('CATTLE', 'Bovins'),
+        ('HORSES', 'Chevaux')]
+months = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP',
+        'OCT', 'NOV', 'DEC']
+words = ['PHARMA', 'HEALTH', 'LABS', 'CARE', 'MEDIC', 'APOTEX', 'TEVA',
+        'SANDOZ', 'MARCAN', 'JAMP', 'AURO', 'PRO DOC', "NATURE'S", 'LIFE']
+
+
+def date(rnd):
+    return '{:02d}-{}-{}'.format(rnd.randint(1, 28), rnd.choice(months),
+            rnd.randint(1990, 2025))
+
+
+def fan(rnd, mean):
+    # number of rows for one drug, averaging mean
+    count = int(mean)
+    if rnd.random() < mean - count:
+        count += 1
+    return count
+
+
+def brand(rnd):
+    return '{} {}'.format(rnd.choice(words), rnd.choice(ingredients))
+
+
+def drug_rows(rnd, code, din):
+    cls, cls_f = rnd.choices(classes, weights=[85, 10, 4, 1])[0]
+    name = brand(rnd)
+    return [[code, rnd.choice(categories), cls, din, name, '', 'N', '',
+        str(rnd.randint(1, 3)), date(rnd), '{:010d}'.format(rnd.randint(0,
+            10**10 - 1)), cls_f, name if rnd.random() < .5 else '', '']]
+
+
+def table_rows(rnd, key, code, count, companies):
+    rows = []
+    for n in range(count):
+        if key == 'active_ingredients':
+            name = rnd.choice(ingredients)
+            unit, unit_f = rnd.choice(units)
+            dosage = rnd.choice(['', '', '5', '1'])
+            rows.append([code, str(rnd.randint(1, 20000)), name, 'N',
+                str(rnd.choice([0.5, 1, 2.5, 5, 10, 25, 81, 200, 325, 500])),
+                unit, 'EQUAL', dosage, 'N', 'ML' if dosage else '', '',
+                ingredients_f.get(name, name.title()), unit_f, 'ÉGAL',
+                'ML' if dosage else ''])
+        elif key == 'companies':
+            company_code, company_name = rnd.choice(companies)
+            rows.append([code, str(rnd.randint(1, 99)), company_code,
+                company_name, 'DIN OWNER', 'N', 'N', 'N', 'Y', '',
+                '{} MAIN STREET'.format(rnd.randint(1, 9999)), 'TORONTO',
+                'ONTARIO', 'CANADA', 'M5V 1A1', '', 'Ontario', 'Canada'])
+        elif key == 'product_status':
+            status, status_f = rnd.choice(statuses)
+            rows.append([code, 'Y' if n == count - 1 else 'N', status,
+                date(rnd), status_f, '', ''])
+        elif key == 'dosage_form':
+            form, form_f = rnd.choice(forms)
+            rows.append([code, str(rnd.randint(1, 200)), form, form_f])
+        elif key == 'packaging':
+            rows.append([code, '', 'ML', 'BOTTLE', str(rnd.choice([30, 100,
+                250])), '{} X {}'.format(rnd.randint(1, 12),
+                rnd.choice(['BLISTER', 'BOTTLE', 'TUBE'])), 'ML', 'Bouteille'])
+        elif key == 'pharmaceutical_standard':
+            rows.append([code, rnd.choice(pharm_stds)])
+        elif key == 'route_of_administration':
+            route, route_f = rnd.choice(routes)
+            rows.append([code, str(rnd.randint(1, 100)), route, route_f])
+        elif key == 'schedule':
+            schedule, schedule_f = rnd.choices(schedules,
+                    weights=[40, 45, 5, 5, 5])[0]
+            rows.append([code, schedule, schedule_f])
+        elif key == 'therapeutic_class':
+            atc = 'N02BE01'
+            rows.append([code, atc, 'ANILIDES', '28:08.92', 'ANALGESICS',
+                'ANILIDES', 'ANALGÉSIQUES'])
+        elif key == 'veterinary_species':
+            animal, animal_f = rnd.choice(species)
+            rows.append([code, animal, '', animal_f])
+    return rows
+
+
+def open_csv(fname):
+    # DPD extracts quote every field and use CRLF line endings
+    f = open(fname, 'w', encoding='utf-8', newline='')
+    return f, csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator='\r\n')
+
+
+def generate_status(out_dir, prod_status, scale, seed, as_zip, first_code):
+    #--------------------------------------------------------------------------
+    # write the extract files of one product status; the rows are written
+    # as the drugs are generated, so the memory used does not grow with the
+    # scale. The members of the archives are written to a scratch directory
+    # first
+    rnd = random.Random('{}-{}'.format(seed, prod_status))
+    suffix = convert_data.suffixes[prod_status]
+    ndrugs = max(1, int(base_drugs[prod_status] * scale))
+    companies = [(str(10000 + n), '{} {} INC'.format(rnd.choice(words),
+        rnd.choice(words))) for n in range(max(10, ndrugs // 20))]
+
+    dir_name = os.path.join(out_dir, 'allfiles' + ('_' + suffix if suffix else ''))
+    ther_name = convert_data.extract_file_name('ther', suffix)
+    files_dir = tempfile.mkdtemp(dir=out_dir) if as_zip else dir_name
+    os.makedirs(files_dir, exist_ok=True)
+
+    fnames = []
+    files = {}
+    writers = {}
+    for key in convert_data.worksheet:
+        fname = convert_data.extract_file_name(
+                convert_data.worksheet[key]['input'], suffix)
+        fnames.append(fname)
+        files[key], writers[key] = open_csv(os.path.join(files_dir, fname))
+    fname = convert_data.extract_file_name('biosimilar', suffix)
+    fnames.append(fname)
+    open(os.path.join(files_dir, fname), 'wb').close()
+
+    nrows = 0
+    for n in range(ndrugs):
+        code = str(first_code + n)
+        din = '{:08d}'.format(rnd.randint(1, 99999999))
+        rows = drug_rows(rnd, code, din)
+        writers['drug_product'].writerows(rows)
+        nrows += len(rows)
+        for key in fan_out:
+            rows = table_rows(rnd, key, code, fan(rnd, fan_out[key]),
+                    companies)
+            writers[key].writerows(rows)
+            nrows += len(rows)
+    for f in files.values():
+        f.close()
+
+    if as_zip:
+        with zipfile.ZipFile(dir_name + '.zip', 'w', zipfile.ZIP_DEFLATED) as zf:
+            for fname in fnames:
+                if fname != ther_name:
+                    zf.write(os.path.join(files_dir, fname), fname)
+        ther_zip = os.path.join(out_dir, ther_name.replace('.txt', '.zip'))
+        with zipfile.ZipFile(ther_zip, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.write(os.path.join(files_dir, ther_name), ther_name)
+        shutil.rmtree(files_dir)
+
+    print('  {}: {} drugs, {} rows'.format(prod_status, ndrugs, nrows))
+    return ndrugs
+
+
+def generate(out_dir, scale=1, prod_statuses=None, seed=0, as_zip=False):
+    os.makedirs(out_dir, exist_ok=True)
+    first_code = 1
+    for prod_status in prod_statuses or list(convert_data.suffixes):
+        first_code += generate_status(out_dir, prod_status, scale, seed,
+                as_zip, first_code)
+
+
+#-------------------------------------------------------------------------------
+if __name__ =='__main__':
+    parser = argparse.ArgumentParser(description='generate synthetic DPD '
+            'extract files')
+    parser.add_argument('-o', '--output', default='bench_data',
+            help='output directory (default: bench_data)')
+    parser.add_argument('--scale', type=float, default=1,
+            help='size relative to the real extracts, e.g. 1, 10, 100')
+    parser.add_argument('--status', nargs='+', choices=list(base_drugs),
+            help='product statuses to generate (default: all)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--zip', action='store_true',
+            help='write allfiles*.zip and ther*.zip archives instead of '
+            'directories')
+    for key in fan_out:
+        parser.add_argument('--' + key.replace('_', '-'), type=float,
+                default=fan_out[key], metavar='N',
+                help='average {} rows per drug'.format(key))
+    args = parser.parse_args()
+
+    for key in fan_out:
+        fan_out[key] = getattr(args, key)
+    generate(args.output, args.scale, args.status, args.seed, args.zip)